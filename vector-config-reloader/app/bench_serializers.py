@@ -0,0 +1,66 @@
+"""Micro-benchmark of the per-event parse/dump cost of each vector config serializer backend.
+
+Usage: python bench_serializers.py [--sources 10 100 1000] [--repeat 20]
+"""
+import argparse, timeit
+import yaml
+
+from utils import LiteralStr, JsonSerializer, YamlSerializer
+
+NODE_METRICS_SOURCE = LiteralStr("""
+.tags.cluster_id = "${CRUSOE_CLUSTER_ID}"
+.tags.vm_id = "${VM_ID}"
+.tags.crusoe_resource = "vm"
+""")
+
+BACKENDS = {
+    "yaml (pure python)": YamlSerializer(loader=yaml.SafeLoader, dumper=yaml.SafeDumper),
+    "yaml (libyaml)": YamlSerializer(),
+    "json": JsonSerializer(),
+}
+
+
+def build_vector_config(num_sources: int) -> dict:
+    sources = {
+        f"svc_{i}_scrape": {
+            "type": "prometheus_scrape",
+            "endpoints": [f"http://10.{i // 250}.{i % 250}.1:9100/metrics"],
+            "scrape_interval_secs": 30,
+            "scrape_timeout_secs": 21,
+        }
+        for i in range(num_sources)
+    }
+    return {
+        "sources": {"host_metrics": {"type": "host_metrics"}, **sources},
+        "transforms": {
+            "enrich_node_metrics": {"type": "remap", "inputs": ["host_metrics"], "source": NODE_METRICS_SOURCE},
+            "enrich_custom_metrics": {"type": "remap", "inputs": sorted(sources), "source": NODE_METRICS_SOURCE},
+        },
+        "sinks": {
+            "cms_gateway_custom_metrics": {
+                "type": "prometheus_remote_write",
+                "inputs": ["enrich_custom_metrics"],
+                "endpoint": "https://cms-monitoring.crusoecloud.com/ingest",
+            },
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sources", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'backend':<20} {'sources':>8} {'bytes':>9} {'parse ms':>10} {'dump ms':>10}")
+    for num_sources in args.sources:
+        cfg = build_vector_config(num_sources)
+        for backend_name, serializer in BACKENDS.items():
+            data = serializer.dumps(cfg)
+            parse_ms = timeit.timeit(lambda: serializer.loads(data), number=args.repeat) / args.repeat * 1000
+            dump_ms = timeit.timeit(lambda: serializer.dumps(cfg), number=args.repeat) / args.repeat * 1000
+            print(f"{backend_name:<20} {num_sources:>8} {len(data):>9} {parse_ms:>10.2f} {dump_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import asyncio, json, os, socket, sys, threading, zlib
+import urllib3
+from kubernetes import client
+from kubernetes.leaderelection import electionconfig, leaderelection
+from kubernetes.leaderelection.resourcelock.configmaplock import ConfigMapLock
+import metrics
+import vector_config_reloader_app
+from utils import FileUtils, YamlUtils
+from vector_config_reloader_app import LOG, POD_LIST_PAGE_SIZE, SYNC_EVENT_TYPE, VectorConfigReloader
+
+CENTRAL_NODE_NAME = "central"
+NODE_CONFIG_MAP_PREFIX = "vector-node-configs"
+NODE_CONFIG_MAP_MAX_BYTES = 1024 * 1024
+CENTRAL_OUTPUT_CONFIG_MAPS = "configmaps"
+CENTRAL_OUTPUT_FILES = "files"
+DEFAULT_CENTRAL_NAMESPACE = "crusoe-system"
+DEFAULT_CENTRAL_SHARDS = 16
+DEFAULT_CENTRAL_OUTPUT_DIR = "/etc/vector-nodes"
+DEFAULT_NODE_SYNC_INTERVAL_SECS = 60
+DEFAULT_LEADER_ELECTION_LOCK_NAME = "vector-config-reloader-leader"
+LEADER_ELECTION_LEASE_DURATION_SECS = 15
+LEADER_ELECTION_RENEW_DEADLINE_SECS = 10
+LEADER_ELECTION_RETRY_PERIOD_SECS = 2
+NODE_SYNC_EVENT_TYPE = "NODE_SYNC"
+MANAGED_BY_LABEL = {"app.kubernetes.io/managed-by": "vector-config-reloader"}
+
+
+class NodeConfigRenderer(VectorConfigReloader):
+    """Desired vector config of one node, kept in memory and published by the central reloader."""
+
+    def write_config(self):
+        # config_dirty stays set until the central reloader has picked the rendered config up
+        pass
+
+
+class CentralConfigReloader(VectorConfigReloader):
+    """Watches the exporter pods of the whole cluster once and renders every node's vector config.
+
+    Pod events are routed by spec.nodeName to a NodeConfigRenderer per node, so the scrape config is built by the same
+    set_*/remove_* logic as the sidecar's. Rendered configs are published as <node>.<ext> keys of a fixed number of
+    sharded ConfigMaps (or files of a shared dir) that the agents mount, only shards with changed nodes are updated.
+    """
+
+    def __init__(self, k8s_api_client=None, reloader_cfg: dict = None):
+        if reloader_cfg is None:
+            reloader_cfg = YamlUtils.load_yaml_config(vector_config_reloader_app.RELOADER_CONFIG_PATH)
+        # exporters aren't reachable from the central reloader, readiness probes and checkpoints stay with the
+        # sidecar mode
+        reloader_cfg = dict(reloader_cfg, readiness_probe={"enabled": False}, checkpoint={"enabled": False})
+        super().__init__(node_name=os.environ.get("NODE_NAME") or CENTRAL_NODE_NAME, k8s_api_client=k8s_api_client, reloader_cfg=reloader_cfg)
+
+        central_cfg = reloader_cfg.get("central", {})
+        self.central_namespace = central_cfg.get("namespace", DEFAULT_CENTRAL_NAMESPACE)
+        self.central_output = central_cfg.get("output", CENTRAL_OUTPUT_CONFIG_MAPS)
+        if self.central_output not in (CENTRAL_OUTPUT_CONFIG_MAPS, CENTRAL_OUTPUT_FILES):
+            raise RuntimeError(f"Unknown central.output {self.central_output}")
+        self.central_output_dir = central_cfg.get("output_dir", DEFAULT_CENTRAL_OUTPUT_DIR)
+        self.central_shards = int(central_cfg.get("shards", DEFAULT_CENTRAL_SHARDS))
+        if self.central_shards < 1:
+            raise RuntimeError(f"central.shards must be at least 1, got {self.central_shards}")
+        self.node_sync_interval_secs = float(central_cfg.get("node_sync_interval_secs", DEFAULT_NODE_SYNC_INTERVAL_SECS))
+        self.leader_election = bool(central_cfg.get("leader_election", True))
+        self.leader_election_lock_name = central_cfg.get("leader_election_lock_name", DEFAULT_LEADER_ELECTION_LOCK_NAME)
+        self.identity = os.environ.get("POD_NAME") or socket.gethostname()
+        self.lost_leadership = False
+
+        # renderers only keep their node's config in memory, the central reloader serves the metrics
+        self.renderer_cfg = dict(reloader_cfg, metrics={"enabled": False})
+        # node name -> renderer, guarded by vector_cfg_lock
+        self.node_renderers = {}
+        # node name -> serialized config, only re-serialized when the node's config changed
+        self.rendered_node_configs = {}
+        # shard -> data last published to its ConfigMap
+        self.published_shards = {}
+
+    def get_renderer(self, node_name: str, pods: list = None) -> NodeConfigRenderer:
+        """Renderer of the node, a new one is bootstrapped from pods (at least the base config)."""
+        with self.vector_cfg_lock:
+            renderer = self.node_renderers.get(node_name)
+        if renderer is not None:
+            return renderer
+        renderer = NodeConfigRenderer(node_name=node_name, k8s_api_client=self.k8s_api_client, reloader_cfg=self.renderer_cfg)
+        renderer.apply_pod_list(pods or [])
+        with self.vector_cfg_lock:
+            return self.node_renderers.setdefault(node_name, renderer)
+
+    def get_pod_field_selector(self) -> str:
+        # watches the pods of all nodes
+        return None
+
+    def list_node_exporter_pods(self):
+        return self.list_exporter_pods("status.phase=Running")
+
+    def apply_pod_list(self, pods: list):
+        pods_by_node = {}
+        for pod in pods:
+            if pod.spec.node_name:
+                pods_by_node.setdefault(pod.spec.node_name, []).append(pod)
+        with self.vector_cfg_lock:
+            node_names = set(self.node_renderers) | set(pods_by_node)
+        for node_name in node_names:
+            with self.vector_cfg_lock:
+                renderer = self.node_renderers.get(node_name)
+            if renderer is None:
+                self.get_renderer(node_name, pods_by_node.get(node_name))
+            else:
+                renderer.apply_pod_list(pods_by_node.get(node_name, []))
+        # published by the config writer, which retries a failed publish
+        self.schedule_config_write()
+        LOG.info(f"Vector configs of {len(node_names)} nodes bootstrapped!")
+
+    def handle_pod_event(self, event):
+        pod = event["object"]
+        if not pod.spec.node_name:
+            # unscheduled pods have nothing to scrape yet
+            return
+        self.get_renderer(pod.spec.node_name).handle_pod_event(event)
+        self.schedule_config_write()
+
+    def list_nodes(self) -> dict:
+        """Node name -> labels of every node in the cluster."""
+        nodes = {}
+        continue_token = None
+        while True:
+            resp = self.k8s_api_client.list_node(limit=POD_LIST_PAGE_SIZE, _continue=continue_token, _preload_content=False)
+            page = json.loads(resp.data)
+            for node in page.get("items") or []:
+                nodes[node["metadata"]["name"]] = node["metadata"].get("labels") or {}
+            continue_token = page["metadata"].get("continue")
+            if not continue_token:
+                return nodes
+
+    def sync_nodes(self, nodes: dict):
+        with self.vector_cfg_lock:
+            for node_name in [node_name for node_name in self.node_renderers if node_name not in nodes]:
+                LOG.info(f"Node {node_name} is gone, dropping its vector config.")
+                self.node_renderers.pop(node_name)
+        for node_name, node_labels in nodes.items():
+            self.get_renderer(node_name).handle_node_labels(node_labels)
+        self.schedule_config_write()
+
+    def dispatch_event(self, event):
+        if event["type"] == NODE_SYNC_EVENT_TYPE:
+            self.sync_nodes(event["object"])
+        else:
+            super().dispatch_event(event)
+
+    def get_shard(self, node_name: str) -> int:
+        # stable across restarts and replicas, unlike hash()
+        return zlib.crc32(node_name.encode()) % self.central_shards
+
+    def get_node_config_map_name(self, shard: int) -> str:
+        return f"{NODE_CONFIG_MAP_PREFIX}-{shard}"
+
+    def get_node_config_key(self, node_name: str) -> str:
+        return self.get_config_file_name(node_name)
+
+    def render_node_configs(self) -> dict:
+        """Node config key -> serialized config of every known node, re-serializing only the changed ones."""
+        with self.vector_cfg_lock:
+            renderers = dict(self.node_renderers)
+        for node_name in [node_name for node_name in self.rendered_node_configs if node_name not in renderers]:
+            self.rendered_node_configs.pop(node_name)
+        for node_name, renderer in renderers.items():
+            with renderer.vector_cfg_lock:
+                if not renderer.config_dirty and node_name in self.rendered_node_configs:
+                    continue
+                renderer.config_dirty = False
+                renderer.set_custom_metrics_sink_tuning(renderer.vector_cfg)
+                self.rendered_node_configs[node_name] = self.config_serializer.dumps(renderer.vector_cfg)
+        return {self.get_node_config_key(node_name): data for node_name, data in self.rendered_node_configs.items()}
+
+    def publish_node_config_map(self, shard: int, data: dict):
+        name = self.get_node_config_map_name(shard)
+        body = {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {"name": name, "namespace": self.central_namespace, "labels": MANAGED_BY_LABEL},
+            "data": data,
+        }
+        try:
+            self.k8s_api_client.replace_namespaced_config_map(name, self.central_namespace, body)
+        except client.ApiException as e:
+            if e.status != 404:
+                raise
+            self.k8s_api_client.create_namespaced_config_map(self.central_namespace, body)
+
+    def publish_node_config_maps(self, node_configs: dict) -> bool:
+        shards = {shard: {} for shard in range(self.central_shards)}
+        for key, data in node_configs.items():
+            shards[self.get_shard(key.rsplit(".", 1)[0])][key] = data
+        published = False
+        oversized = []
+        for shard, data in shards.items():
+            if self.published_shards.get(shard) == data:
+                continue
+            size = sum(len(key) + len(value) for key, value in data.items())
+            if size > NODE_CONFIG_MAP_MAX_BYTES:
+                # the API server would reject it, the nodes of this shard keep their last published config
+                oversized.append(f"{self.get_node_config_map_name(shard)} ({size} bytes)")
+                continue
+            self.publish_node_config_map(shard, data)
+            self.published_shards[shard] = data
+            published = True
+        if oversized:
+            raise RuntimeError(f"Node configs above the 1MiB ConfigMap limit in {', '.join(oversized)}, raise central.shards.")
+        return published
+
+    def publish_node_config_files(self, node_configs: dict) -> bool:
+        written = False
+        for key, data in node_configs.items():
+            written |= FileUtils.write_if_changed(os.path.join(self.central_output_dir, key), data)
+        for name in os.listdir(self.central_output_dir):
+            if name.endswith(f".{self.config_serializer.extension}") and name not in node_configs:
+                os.unlink(os.path.join(self.central_output_dir, name))
+                written = True
+        return written
+
+    @metrics.CONFIG_WRITE_SECONDS.time()
+    def write_config(self):
+        with self.config_write_lock:
+            if self.lost_leadership:
+                # the new leader publishes from here on
+                return
+            with self.vector_cfg_lock:
+                self.config_dirty = False
+            try:
+                node_configs = self.render_node_configs()
+                if self.central_output == CENTRAL_OUTPUT_FILES:
+                    written = self.publish_node_config_files(node_configs)
+                else:
+                    written = self.publish_node_config_maps(node_configs)
+            except BaseException:
+                with self.vector_cfg_lock:
+                    # unpublished shards still differ from published_shards and go out with the next write
+                    self.config_dirty = True
+                raise
+        if written:
+            metrics.CONFIG_WRITES.inc()
+            LOG.info(f"Vector node configs published!")
+        else:
+            metrics.CONFIG_WRITES_SKIPPED.inc()
+            LOG.debug(f"Vector node configs unchanged, skipped publish.")
+
+    async def node_sync_loop(self):
+        # adds renderers for new nodes, drops those of deleted nodes and keeps node label tags up to date
+        while True:
+            try:
+                nodes = await asyncio.to_thread(self.list_nodes)
+                await self.event_queue.put({"type": NODE_SYNC_EVENT_TYPE, "object": nodes})
+            except client.ApiException as e:
+                metrics.API_ERRORS.labels(str(e.status)).inc()
+                LOG.error(f"k8s node list error: {e}")
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                metrics.API_ERRORS.labels("connection").inc()
+                LOG.error(f"k8s node list connection error: {e}")
+            await asyncio.sleep(self.node_sync_interval_secs)
+
+    def get_initial_sync_event_types(self) -> set:
+        # node label tags come with the node sync, a node's config is republished when they change
+        return {SYNC_EVENT_TYPE}
+
+    def get_background_coroutines(self) -> list:
+        # one periodic node list replaces the per node watches
+        return [self.config_writer(), self.node_sync_loop()]
+
+    def on_stopped_leading(self):
+        LOG.error("Lost leadership, shutting down.")
+        self.lost_leadership = True
+        self.request_shutdown()
+
+    def execute(self):
+        if not self.leader_election:
+            return super().execute()
+        became_leader = threading.Event()
+        election = leaderelection.LeaderElection(electionconfig.Config(
+            ConfigMapLock(self.leader_election_lock_name, self.central_namespace, self.identity),
+            lease_duration=LEADER_ELECTION_LEASE_DURATION_SECS,
+            renew_deadline=LEADER_ELECTION_RENEW_DEADLINE_SECS,
+            retry_period=LEADER_ELECTION_RETRY_PERIOD_SECS,
+            onstarted_leading=became_leader.set,
+            onstopped_leading=self.on_stopped_leading,
+        ))
+        threading.Thread(target=election.run, name="leader-election", daemon=True).start()
+        LOG.info(f"Waiting for leadership of {self.central_namespace}/{self.leader_election_lock_name} as {self.identity}.")
+        became_leader.wait()
+        LOG.info("Became leader, watching exporter pods of all nodes.")
+        super().execute()
+        if self.lost_leadership:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    CentralConfigReloader().execute()
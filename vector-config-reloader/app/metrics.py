@@ -0,0 +1,73 @@
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server
+
+# dedicated registry, only the reloader's own metrics are exposed
+REGISTRY = CollectorRegistry()
+METRICS_NAMESPACE = "vector_config_reloader"
+
+POD_EVENT_HANDLING_SECONDS = Histogram(
+    "pod_event_handling_seconds", "Time spent applying a pod event to the desired vector config.",
+    namespace=METRICS_NAMESPACE, registry=REGISTRY,
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+CONFIG_WRITE_SECONDS = Histogram(
+    "config_write_seconds", "Time spent rendering and writing the vector config.",
+    namespace=METRICS_NAMESPACE, registry=REGISTRY,
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+POD_EVENTS = Counter(
+    "pod_events", "Pod events received from the watch, by event type.",
+    ["type"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+CONFIG_WRITES = Counter(
+    "config_writes", "Vector config writes that changed at least one file.",
+    namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+CONFIG_WRITES_SKIPPED = Counter(
+    "config_writes_skipped", "Vector config writes skipped because the rendered config did not change.",
+    namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+WATCH_RECONNECTS = Counter(
+    "watch_reconnects", "Pod watch reconnects, by reason (timeout, error, gone).",
+    ["reason"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+API_ERRORS = Counter(
+    "api_errors", "Errors returned by the kubernetes API, by HTTP status (connection for transport errors).",
+    ["status"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+POD_EVENT_QUEUE_SIZE = Gauge(
+    "pod_event_queue_size", "Pod events waiting between the watch and the event worker.",
+    namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+EVENT_HANDLING_ERRORS = Counter(
+    "event_handling_errors", "Queued events that failed to apply to the desired vector config, by event type.",
+    ["type"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+CONFIG_WRITE_ERRORS = Counter(
+    "config_write_errors", "Vector config writes (or node config publishes) that failed and are retried.",
+    namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+ENDPOINT_PROBE_REJECTIONS = Counter(
+    "endpoint_probe_rejections", "Exporter endpoints not added because their readiness probe failed, by kind and reason.",
+    ["kind", "reason"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+SOURCE_SERIES_LIMIT = Gauge(
+    "source_series_limit", "Distinct values allowed per tag of a cardinality limited scrape source, by source.",
+    ["source"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+ACTIVE_SCRAPE_SOURCES = Gauge(
+    "active_scrape_sources", "Scrape sources in the rendered vector config, by exporter kind.",
+    ["kind"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+ACTIVE_SCRAPE_ENDPOINTS = Gauge(
+    "active_scrape_endpoints", "Scrape endpoints in the rendered vector config, by exporter kind.",
+    ["kind"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+
+RECONCILED_SOURCES = Counter(
+    "reconciled_sources", "Scrape sources the reconciliation sweep removed as stale or added as missing, by action.",
+    ["action"], namespace=METRICS_NAMESPACE, registry=REGISTRY,
+)
+
+
+def start_metrics_server(address: str, port: int):
+    return start_http_server(port, addr=address, registry=REGISTRY)
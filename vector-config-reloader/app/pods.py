@@ -0,0 +1,70 @@
+class PodMetadata:
+    __slots__ = ("name", "namespace", "uid", "labels", "annotations", "deletion_timestamp", "resource_version")
+
+    def __init__(self, name, namespace, uid=None, labels=None, annotations=None, deletion_timestamp=None, resource_version=None):
+        self.name = name
+        self.namespace = namespace
+        self.uid = uid
+        self.labels = labels or {}
+        self.annotations = annotations or {}
+        self.deletion_timestamp = deletion_timestamp
+        self.resource_version = resource_version
+
+
+class PodSpec:
+    __slots__ = ("node_name",)
+
+    def __init__(self, node_name=None):
+        self.node_name = node_name
+
+
+class PodStatus:
+    __slots__ = ("phase", "pod_ip")
+
+    def __init__(self, phase=None, pod_ip=None):
+        self.phase = phase
+        self.pod_ip = pod_ip
+
+
+class PodRecord:
+    """Compact projection of the V1Pod fields the reloader reads, built straight from the API server JSON."""
+    __slots__ = ("metadata", "spec", "status")
+
+    def __init__(self, metadata: PodMetadata, spec: PodSpec, status: PodStatus):
+        self.metadata = metadata
+        self.spec = spec
+        self.status = status
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "PodRecord":
+        metadata = raw.get("metadata") or {}
+        spec = raw.get("spec") or {}
+        status = raw.get("status") or {}
+        return cls(
+            PodMetadata(
+                name=metadata.get("name"),
+                namespace=metadata.get("namespace"),
+                uid=metadata.get("uid"),
+                labels=metadata.get("labels"),
+                annotations=metadata.get("annotations"),
+                deletion_timestamp=metadata.get("deletionTimestamp"),
+                resource_version=metadata.get("resourceVersion"),
+            ),
+            PodSpec(node_name=spec.get("nodeName")),
+            PodStatus(phase=status.get("phase"), pod_ip=status.get("podIP")),
+        )
+
+    @staticmethod
+    def to_dict(pod) -> dict:
+        """Inverse of from_dict for the fields the reloader reads, accepts any pod object with the same attributes."""
+        return {
+            "metadata": {
+                "name": pod.metadata.name,
+                "namespace": pod.metadata.namespace,
+                "uid": pod.metadata.uid,
+                "labels": pod.metadata.labels,
+                "annotations": pod.metadata.annotations,
+            },
+            "spec": {"nodeName": pod.spec.node_name},
+            "status": {"phase": pod.status.phase, "podIP": pod.status.pod_ip},
+        }
@@ -0,0 +1,120 @@
+import re, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+import metrics
+
+PROBE_READ_LIMIT_BYTES = 64 * 1024
+PROBE_BACKOFF_MAX_SECS = 30
+PROMETHEUS_CONTENT_TYPES = ("text/plain", "application/openmetrics-text")
+# first line of a text exposition: a HELP/TYPE comment or a sample
+PROMETHEUS_TEXT_LINE = re.compile(r"^(# (HELP|TYPE) |[a-zA-Z_:][a-zA-Z0-9_:]*(\{| ))")
+
+
+class ProbeResult:
+    __slots__ = ("url", "ready", "reason", "expires_at")
+
+    def __init__(self, url: str, ready: bool, reason: str, expires_at: float):
+        self.url = url
+        self.ready = ready
+        self.reason = reason
+        self.expires_at = expires_at
+
+
+class EndpointProber:
+    """Checks that exporter endpoints serve Prometheus text before they are added as scrape sources.
+
+    Probes run on a bounded thread pool and retry with exponential backoff. Results are cached per (pod uid, pod ip)
+    so the status updates of a running pod don't probe it again until the TTL expires.
+    """
+
+    def __init__(self, timeout_secs: float, max_concurrency: int, retries: int, backoff_secs: float, cache_ttl_secs: float):
+        self.retries = retries
+        self.backoff_secs = backoff_secs
+        self.cache_ttl_secs = cache_ttl_secs
+        self.http = urllib3.PoolManager(
+            num_pools=max_concurrency, maxsize=1, retries=False,
+            timeout=urllib3.Timeout(connect=timeout_secs, read=timeout_secs),
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="endpoint-probe")
+        self.cache = {}
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def probe_once(self, url: str):
+        """Returns (ready, reason), reason is the rejection reason of a failed probe."""
+        try:
+            resp = self.http.request("GET", url, preload_content=False, headers={"Accept": "text/plain"})
+        except urllib3.exceptions.TimeoutError:
+            return False, "timeout"
+        except urllib3.exceptions.HTTPError:
+            return False, "connection"
+        try:
+            if resp.status != 200:
+                return False, "status"
+            content_type = resp.headers.get("Content-Type", "")
+            if content_type.startswith(PROMETHEUS_CONTENT_TYPES):
+                return True, None
+            # some exporters don't set a content type, fall back to sniffing the body
+            body = resp.read(PROBE_READ_LIMIT_BYTES, decode_content=True).decode("utf-8", errors="replace")
+            first_line = next((line for line in body.splitlines() if line.strip()), "")
+            if PROMETHEUS_TEXT_LINE.match(first_line):
+                return True, None
+            return False, "not_prometheus"
+        except urllib3.exceptions.HTTPError:
+            return False, "connection"
+        finally:
+            resp.release_conn()
+
+    def probe(self, uid: str, ip: str, url: str, kind: str):
+        ready, reason = False, None
+        for attempt in range(self.retries + 1):
+            if attempt and self.stopped.wait(min(self.backoff_secs * 2 ** (attempt - 1), PROBE_BACKOFF_MAX_SECS)):
+                break
+            ready, reason = self.probe_once(url)
+            if ready:
+                break
+        with self.lock:
+            self.cache[(uid, ip)] = ProbeResult(url, ready, reason, time.monotonic() + self.cache_ttl_secs)
+        if not ready and reason is not None:
+            metrics.ENDPOINT_PROBE_REJECTIONS.labels(kind, reason).inc()
+        return ready, reason
+
+    def get_cached(self, uid: str, ip: str, url: str):
+        """True/False for a fresh cached result of the same url, None when the endpoint has to be probed."""
+        with self.lock:
+            result = self.cache.get((uid, ip))
+            if result is None or result.url != url or result.expires_at < time.monotonic():
+                return None
+            return result.ready
+
+    def submit(self, uid: str, ip: str, url: str, kind: str, callback):
+        """Probes the endpoint in the background and calls callback(ready, reason), unless it is already being probed."""
+        key = (uid, ip, url)
+        with self.lock:
+            if key in self.in_flight or self.stopped.is_set():
+                return
+            self.in_flight.add(key)
+
+        def run():
+            try:
+                ready, reason = self.probe(uid, ip, url, kind)
+            finally:
+                with self.lock:
+                    self.in_flight.discard(key)
+            if not self.stopped.is_set():
+                callback(ready, reason)
+
+        self.executor.submit(run)
+
+    def forget(self, uid: str):
+        with self.lock:
+            for key in [key for key in self.cache if key[0] == uid]:
+                self.cache.pop(key)
+
+    def shutdown(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.http.clear()
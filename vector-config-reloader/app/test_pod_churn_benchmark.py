@@ -0,0 +1,263 @@
+"""Pod churn benchmark for the config reloader, runs under pytest without a cluster.
+
+A synthetic generator produces bursty create/delete storms of DCGM exporters, custom metrics exporters and unrelated
+pods. The events are served by a fake CoreV1Api and go through the same raw list/watch path, event queue and config
+writer the reloader uses against the API server. The run reports events/sec, pod Running -> config written latency
+(p50/p99), bytes written and config writes per event. By default a small run checks that storms are coalesced and
+every Running exporter gets written. CHURN_BENCH=1 runs the full size and also asserts the wall clock latency, scale it
+up with CHURN_BENCH_PODS / CHURN_BENCH_STORM_SIZE, print the report with -s.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+import pytest
+import yaml
+
+import vector_config_reloader_app
+from utils import FileUtils
+from vector_config_reloader_app import VectorConfigReloader, CUSTOM_METRICS_SCRAPE_ANNOTATION, DCGM_EXPORTER_APP_LABEL
+
+# timing assertions depend on the runner, they only run when the benchmark is asked for
+BENCH_ENABLED = os.environ.get("CHURN_BENCH") == "1"
+BENCH_PODS = int(os.environ.get("CHURN_BENCH_PODS", 1000 if BENCH_ENABLED else 128))
+BENCH_STORM_SIZE = int(os.environ.get("CHURN_BENCH_STORM_SIZE", 64 if BENCH_ENABLED else 32))
+BENCH_DEBOUNCE_SECS = 0.05
+BENCH_NODE_NAME = "bench-node"
+
+
+class ChurnEventGenerator:
+    """Produces watch events for pods that are created and deleted in storms, like gang scheduled jobs."""
+
+    def __init__(self, num_pods: int, storm_size: int, exporter_ratio: float = 0.5, seed: int = 7):
+        self.num_pods = num_pods
+        self.storm_size = storm_size
+        self.exporter_ratio = exporter_ratio
+        self.random = random.Random(seed)
+        self.resource_version = 1
+
+    def next_resource_version(self) -> str:
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def new_pod(self, index: int) -> dict:
+        labels, annotations = {"job": f"job-{index // self.storm_size}"}, {}
+        if index % self.storm_size == 0:
+            labels["app"] = DCGM_EXPORTER_APP_LABEL
+        elif self.random.random() < self.exporter_ratio:
+            annotations[CUSTOM_METRICS_SCRAPE_ANNOTATION] = "true"
+        return {
+            "metadata": {
+                "name": f"pod-{index}",
+                "namespace": "bench",
+                "uid": f"uid-{index}",
+                "labels": labels,
+                "annotations": annotations,
+            },
+            "spec": {"nodeName": BENCH_NODE_NAME},
+            "status": {"phase": "Pending", "podIP": f"10.{index // 250 % 250}.{index % 250}.1"},
+        }
+
+    def event(self, event_type: str, pod: dict) -> dict:
+        pod = json.loads(json.dumps(pod))
+        pod["metadata"]["resourceVersion"] = self.next_resource_version()
+        return {"type": event_type, "object": pod}
+
+    def storms(self):
+        """Yields one list of events per storm: the pods of the previous storm go away while a new job starts."""
+        previous_storm = []
+        for start in range(0, self.num_pods, self.storm_size):
+            storm = [self.new_pod(index) for index in range(start, min(start + self.storm_size, self.num_pods))]
+            events = []
+            for pod in storm:
+                events.append(self.event("ADDED", pod))
+                pod["status"]["phase"] = "Running"
+                events.append(self.event("MODIFIED", pod))
+            for pod in previous_storm:
+                pod["metadata"]["deletionTimestamp"] = "2025-01-01T00:00:00Z"
+                events.append(self.event("MODIFIED", pod))
+                events.append(self.event("DELETED", pod))
+            self.random.shuffle(events)
+            events.append({"type": "BOOKMARK", "object": {"metadata": {"resourceVersion": self.next_resource_version()}}})
+            yield events
+            previous_storm = storm
+
+
+class FakeResponse:
+    def __init__(self, data=b"", lines=()):
+        self.data = data
+        self.lines = lines
+
+    def stream(self, *args, **kwargs):
+        yield from self.lines
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class FakeCoreV1Api:
+    """Serves an initial pod list and a watch stream that replays the generated storms with a pause in between."""
+
+    def __init__(self, initial_pods: list, generator: ChurnEventGenerator, storm_gap_secs: float):
+        self.initial_pods = initial_pods
+        self.generator = generator
+        self.storm_gap_secs = storm_gap_secs
+        self.delivered = []
+        self.on_exhausted = None
+
+    def list_pod_for_all_namespaces(self, watch=False, limit=None, _continue=None, **kwargs):
+        if watch:
+            return FakeResponse(lines=self.stream_lines())
+        start = int(_continue or 0)
+        end = start + limit if limit else len(self.initial_pods)
+        page = {"metadata": {"resourceVersion": "1"}, "items": self.initial_pods[start:end]}
+        if end < len(self.initial_pods):
+            page["metadata"]["continue"] = str(end)
+        return FakeResponse(data=json.dumps(page).encode())
+
+    def stream_lines(self):
+        for storm in self.generator.storms():
+            for event in storm:
+                self.delivered.append(time.perf_counter())
+                yield json.dumps(event).encode() + b"\n"
+            # idle gap between jobs, lets the debounced write go out
+            time.sleep(self.storm_gap_secs)
+        self.on_exhausted()
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run_churn_benchmark(monkeypatch, tmp_path, num_pods: int, storm_size: int, debounce_secs: float, output_mode: str = "single") -> dict:
+    generator = ChurnEventGenerator(num_pods, storm_size)
+    initial_pods = [generator.new_pod(num_pods + index) for index in range(storm_size)]
+    for pod in initial_pods:
+        pod["status"]["phase"] = "Running"
+    fake_api = FakeCoreV1Api(initial_pods, generator, storm_gap_secs=debounce_secs * 2)
+
+    reloader_cfg = {
+        "dcgm_metrics": {"port": 9400, "path": "/metrics", "scrape_interval": 30},
+        "custom_metrics": {"port": 9100, "path": "/metrics", "scrape_interval": 30},
+        "sink": {"endpoint": "https://cms-monitoring.example.com/ingest"},
+        "vector_config": {"debounce_secs": debounce_secs, "output_mode": output_mode},
+        "log_level": "WARNING",
+    }
+    base_vector_cfg = {
+        "sources": {"host_metrics": {"type": "host_metrics"}},
+        "transforms": {"enrich_node_metrics": {"type": "remap", "inputs": ["host_metrics"], "source": "."}},
+        "sinks": {"cms_gateway_node_metrics": {"type": "prometheus_remote_write", "inputs": ["enrich_node_metrics"], "endpoint": ""}},
+    }
+    config_dir = tmp_path / "vector"
+    config_dir.mkdir()
+    (tmp_path / "reloader.yaml").write_text(yaml.safe_dump(reloader_cfg))
+    (tmp_path / "vector-base.yaml").write_text(yaml.safe_dump(base_vector_cfg))
+    monkeypatch.setenv("NODE_NAME", BENCH_NODE_NAME)
+    monkeypatch.setattr("vector_config_reloader_app.RELOADER_CONFIG_PATH", str(tmp_path / "reloader.yaml"))
+    monkeypatch.setattr("vector_config_reloader_app.VECTOR_BASE_CONFIG_PATH", str(tmp_path / "vector-base.yaml"))
+    monkeypatch.setattr("vector_config_reloader_app.VECTOR_CONFIG_PATH", str(config_dir / "vector.yaml"))
+    monkeypatch.setattr("vector_config_reloader_app.config.load_incluster_config", lambda: None)
+    monkeypatch.setattr("vector_config_reloader_app.client.CoreV1Api", lambda: fake_api)
+
+    reloader = VectorConfigReloader()
+
+    writes = []
+    original_atomic_write = FileUtils.atomic_write
+    monkeypatch.setattr(FileUtils, "atomic_write", lambda path, data: (writes.append(len(data)), original_atomic_write(path, data)))
+
+    fake_api.on_exhausted = reloader.request_shutdown
+
+    original_enqueue_pod_event = reloader.enqueue_pod_event
+
+    def enqueue_pod_event(event):
+        event["delivered_at"] = fake_api.delivered[-1]
+        original_enqueue_pod_event(event)
+
+    monkeypatch.setattr(reloader, "enqueue_pod_event", enqueue_pod_event)
+
+    # event index -> time it was delivered, for exporter pods turning Running
+    running_events = {}
+    handled = []
+    original_handle_pod_event = reloader.handle_pod_event
+
+    def handle_pod_event(event):
+        pod = event["object"]
+        if pod.status.phase == "Running" and pod.metadata.deletion_timestamp is None:
+            running_events[len(handled)] = event["delivered_at"]
+        original_handle_pod_event(event)
+        handled.append(1)
+
+    monkeypatch.setattr(reloader, "handle_pod_event", handle_pod_event)
+
+    # (events handled before the write started, time the write finished)
+    flushes = []
+    original_write_config = reloader.write_config
+
+    def write_config():
+        handled_before = len(handled)
+        original_write_config()
+        flushes.append((handled_before, time.perf_counter()))
+
+    monkeypatch.setattr(reloader, "write_config", write_config)
+
+    started = time.perf_counter()
+    asyncio.run(reloader.run())
+    elapsed = time.perf_counter() - started
+
+    latencies_ms = []
+    for index, delivered in running_events.items():
+        flushed = next((finished for handled_before, finished in flushes if handled_before > index), None)
+        if flushed is not None:
+            latencies_ms.append((flushed - delivered) * 1000)
+
+    idle_secs = fake_api.storm_gap_secs * len(range(0, num_pods, storm_size))
+    # the bootstrap write goes through the config writer too and is counted with the event writes
+    event_writes = len(writes)
+    return {
+        "events": len(fake_api.delivered),
+        "exporter_events": len(handled),
+        "events_per_sec": len(fake_api.delivered) / max(elapsed - idle_secs, 1e-9),
+        "latency_p50_ms": percentile(latencies_ms, 50),
+        "latency_p99_ms": percentile(latencies_ms, 99),
+        "config_writes": event_writes,
+        "bytes_written": sum(writes),
+        "writes_per_event": event_writes / max(len(handled), 1),
+        "unflushed_running_events": len(running_events) - len(latencies_ms),
+    }
+
+
+def print_report(name: str, report: dict):
+    print(f"\n{name}: " + ", ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}" for key, value in report.items()))
+
+
+@pytest.mark.parametrize("output_mode", ["single", "fragments"])
+def test_churn_storms_are_coalesced(monkeypatch, tmp_path, output_mode):
+    report = run_churn_benchmark(monkeypatch, tmp_path, BENCH_PODS, BENCH_STORM_SIZE, BENCH_DEBOUNCE_SECS, output_mode)
+    print_report(f"churn debounce={BENCH_DEBOUNCE_SECS}s mode={output_mode}", report)
+
+    storms = len(range(0, BENCH_PODS, BENCH_STORM_SIZE))
+    assert report["unflushed_running_events"] == 0
+    # a storm of exporter events is flushed in a handful of writes, not one per event
+    assert report["writes_per_event"] < 0.5
+    if output_mode == "single":
+        assert report["config_writes"] <= 2 * storms
+    if BENCH_ENABLED:
+        # Running pods get scraped within about one debounce window
+        assert report["latency_p99_ms"] < BENCH_DEBOUNCE_SECS * 1000 * 20
+
+
+def test_churn_without_debounce_baseline(monkeypatch, tmp_path):
+    num_pods = min(BENCH_PODS, 256)
+    report = run_churn_benchmark(monkeypatch, tmp_path, num_pods, BENCH_STORM_SIZE, debounce_secs=0)
+    print_report("churn debounce=0s mode=single", report)
+
+    assert report["unflushed_running_events"] == 0
+    assert report["config_writes"] > 0
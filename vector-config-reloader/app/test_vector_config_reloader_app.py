@@ -1,23 +1,45 @@
+import asyncio
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.request
 import yaml
 import pytest
-import types
 
+from kubernetes import client
+
+import metrics
+import vector_config_reloader_app
+from central_reloader import CentralConfigReloader
+from pods import PodRecord
+from probes import EndpointProber
+from utils import FileUtils, LiteralStr, YamlSerializer, YamlUtils, get_serializer
 from vector_config_reloader_app import (
     VectorConfigReloader,
     CUSTOM_METRICS_SCRAPE_ANNOTATION,
     CUSTOM_METRICS_PORT_ANNOTATION,
     CUSTOM_METRICS_PATH_ANNOTATION,
     CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION,
+    CUSTOM_METRICS_INCLUDE_ANNOTATION,
+    CUSTOM_METRICS_EXCLUDE_ANNOTATION,
+    CUSTOM_METRICS_MAX_SERIES_ANNOTATION,
+    CUSTOM_METRICS_SERIES_LIMIT_ACTION_ANNOTATION,
+    CUSTOM_METRICS_DOWNSAMPLE_INTERVAL_ANNOTATION,
+    CUSTOM_METRICS_DOWNSAMPLE_MODE_ANNOTATION,
     CUSTOM_METRICS_VECTOR_TRANSFORM_NAME,
 )
 
 class DummyPod:
-    def __init__(self, name, ns, ip=None, labels=None, ann=None, phase="Running"):
+    def __init__(self, name, ns, ip=None, labels=None, ann=None, phase="Running", uid=None):
         self.metadata = type("M", (), {})()
         self.metadata.name = name
         self.metadata.namespace = ns
+        self.metadata.uid = uid or f"uid-{ns}-{name}"
         self.metadata.annotations = ann or {}
         self.metadata.labels = labels or {}
+        self.metadata.deletion_timestamp = None
         self.status = type("S", (), {})()
         self.status.phase = phase
         self.status.pod_ip = ip
@@ -25,27 +47,67 @@ class DummyPod:
         self.spec = type("Spec", (), {})()
         self.spec.node_name = "test-node"
 
+def _pod_to_dict(pod, resource_version="1"):
+    return {
+        "metadata": {
+            "name": pod.metadata.name,
+            "namespace": pod.metadata.namespace,
+            "uid": pod.metadata.uid,
+            "labels": pod.metadata.labels,
+            "annotations": pod.metadata.annotations,
+            "resourceVersion": resource_version,
+        },
+        "spec": {"nodeName": pod.spec.node_name},
+        "status": {"phase": pod.status.phase, "podIP": pod.status.pod_ip},
+    }
+
 @pytest.fixture(autouse=True)
 def _isolate_env(monkeypatch, tmp_path):
     """Ensure required env vars and k8s/config dependencies are patched for tests."""
     # Required by VectorConfigReloader.__init__
     monkeypatch.setenv("NODE_NAME", "test-node")
 
-    # Patch kubernetes config/client/watch used in module to simple dummies
+    # Patch kubernetes config/client used in module to simple dummies
+    class _DummyResponse:
+        def __init__(self, data=b"", lines=()):
+            self.data = data
+            self._lines = lines
+
+        def stream(self, *args, **kwargs):
+            yield from self._lines
+
+        def close(self):
+            pass
+
+        def release_conn(self):
+            pass
+
     class _DummyCoreV1Api:
         def __init__(self):
             self._pods = []
+            self._events = []
+            self.list_calls = []
+            self._node = None
+            self._node_events = []
 
-        def list_pod_for_all_namespaces(self, **kwargs):
-            return types.SimpleNamespace(items=self._pods)
+        def list_node(self, watch=False, **kwargs):
+            if watch:
+                return _DummyResponse(lines=[json.dumps(e).encode() + b"\n" for e in self._node_events])
+            return _DummyResponse(json.dumps({"metadata": {"resourceVersion": "1"}, "items": [self._node] if self._node else []}).encode())
 
-    class _DummyWatch:
-        def stream(self, *args, **kwargs):
-            return []
+        def list_pod_for_all_namespaces(self, watch=False, limit=None, _continue=None, **kwargs):
+            if watch:
+                return _DummyResponse(lines=[json.dumps(e).encode() + b"\n" for e in self._events])
+            self.list_calls.append({"limit": limit, "_continue": _continue, **kwargs})
+            start = int(_continue or 0)
+            end = start + limit if limit else len(self._pods)
+            page = {"metadata": {"resourceVersion": "1"}, "items": [_pod_to_dict(p) for p in self._pods[start:end]]}
+            if end < len(self._pods):
+                page["metadata"]["continue"] = str(end)
+            return _DummyResponse(json.dumps(page).encode())
 
     # Patch into module namespace
     monkeypatch.setattr("vector_config_reloader_app.client.CoreV1Api", _DummyCoreV1Api)
-    monkeypatch.setattr("vector_config_reloader_app.watch.Watch", lambda: _DummyWatch())
     monkeypatch.setattr("vector_config_reloader_app.config.load_incluster_config", lambda: None)
 
     # Provide temp files for config paths
@@ -107,6 +169,15 @@ def _new_reloader_with_pods(monkeypatch, pods):
     return r
 
 
+def _bootstrap(r):
+    """Same start as run() without the event loop: restore the checkpoint, list the exporter pods, write the config."""
+    r.restore_checkpoint()
+    pods, resource_version = r.list_node_exporter_pods()
+    r.apply_pod_list(pods)
+    r.flush_config()
+    return resource_version
+
+
 def test_get_custom_metrics_endpoint_cfg_defaults_and_min_threshold(monkeypatch):
     r = _new_reloader_with_pods(monkeypatch, [])
 
@@ -171,3 +242,1105 @@ def test_set_and_remove_custom_metrics_scrape_config(monkeypatch):
     r.remove_custom_metrics_scrape_config(vector_cfg, eps[1])
     assert vector_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] == []
     assert "cms_gateway_custom_metrics" not in vector_cfg["sinks"]
+
+
+def test_write_if_changed_is_atomic_and_skips_unchanged(tmp_path):
+    path = tmp_path / "vector.yaml"
+    cfg = {"sources": {"a": {"type": "host_metrics"}}}
+    serializer = YamlSerializer()
+
+    assert FileUtils.write_if_changed(str(path), serializer.dumps(cfg))
+    assert yaml.safe_load(path.read_text()) == cfg
+    # identical content -> no write
+    assert not FileUtils.write_if_changed(str(path), serializer.dumps(cfg))
+
+    cfg["sources"]["b"] = {"type": "internal_metrics"}
+    assert FileUtils.write_if_changed(str(path), serializer.dumps(cfg))
+    # no temp files left behind next to the config
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith(".tmp")] == []
+
+
+def test_pod_events_are_coalesced_into_single_write(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    _bootstrap(r)
+
+    writes = []
+    original_atomic_write = FileUtils.atomic_write
+    monkeypatch.setattr(FileUtils, "atomic_write", lambda path, data: (writes.append(path), original_atomic_write(path, data)))
+
+    r.config_write_debounce_secs = 60
+    for i in range(5):
+        pod = DummyPod(f"svc-{i}", "ns", ip=f"10.3.0.{i}", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+        r.handle_pod_event({"type": "ADDED", "object": pod})
+    assert writes == [], writes
+
+    r.flush_config()
+    assert len(writes) == 1
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert {f"svc_{i}_scrape" for i in range(5)} <= set(written_cfg["sources"])
+
+    # re-applying the same pod renders identical bytes -> write skipped
+    r.handle_pod_event({"type": "MODIFIED", "object": DummyPod("svc-0", "ns", ip="10.3.0.0", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})})
+    r.flush_config()
+    assert len(writes) == 1
+
+
+def _pod_event(event_type, pod, resource_version):
+    raw_pod = _pod_to_dict(pod, resource_version) if pod else {"metadata": {"resourceVersion": resource_version}}
+    return {"type": event_type, "object": raw_pod}
+
+
+def test_execute_resumes_watch_from_resource_version_and_relists_on_gone(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.config_write_debounce_secs = 0
+    monkeypatch.setattr("vector_config_reloader_app.random.uniform", lambda a, b: 0)
+
+    bootstraps = []
+    original_list = r.list_node_exporter_pods
+    monkeypatch.setattr(r, "list_node_exporter_pods", lambda: (bootstraps.append(1), original_list())[1])
+
+    stream_kwargs = []
+    cm_pod = DummyPod("svc-a", "ns", ip="10.4.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+
+    def scripted_stream(**kwargs):
+        stream_kwargs.append(kwargs)
+        call = len(stream_kwargs)
+        if call == 1:
+            yield _pod_event("ADDED", cm_pod, "5")
+            yield _pod_event("BOOKMARK", None, "7")
+        elif call == 2:
+            raise client.ApiException(status=500, reason="Internal Server Error")
+        elif call == 3:
+            raise client.ApiException(status=410, reason="Gone")
+        else:
+            r.running = False
+            yield _pod_event("BOOKMARK", None, "9")
+
+    monkeypatch.setattr(r, "stream_pod_events", scripted_stream)
+    r.execute()
+
+    # resumed from the bootstrap list, then the last bookmark, then the fresh re-list after 410
+    assert [kw["resource_version"] for kw in stream_kwargs] == ["1", "7", "7", "1"]
+    assert all(kw["allow_watch_bookmarks"] for kw in stream_kwargs)
+    assert len(bootstraps) == 2
+    assert r.watch_failures == 0
+
+
+def test_execute_gives_up_after_max_consecutive_watch_failures(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    monkeypatch.setattr("vector_config_reloader_app.random.uniform", lambda a, b: 0)
+
+    attempts = []
+
+    def failing_stream(**kwargs):
+        attempts.append(kwargs)
+        raise client.ApiException(status=503, reason="Service Unavailable")
+
+    monkeypatch.setattr(r, "stream_pod_events", failing_stream)
+    r.execute()
+
+    assert len(attempts) == vector_config_reloader_app.MAX_EVENT_WATCHER_RETRIES + 1
+
+
+def test_bootstrap_lists_pods_paginated_and_prefilters_raw_pods(monkeypatch):
+    monkeypatch.setattr("vector_config_reloader_app.POD_LIST_PAGE_SIZE", 2)
+    pods = [DummyPod(f"other-{i}", "ns", ip=f"10.5.0.{i}", labels={"app": "other"}) for i in range(3)]
+    pods.append(DummyPod("svc-cm", "ns", ip="10.5.1.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"}))
+    pods.append(DummyPod("dcgm", "ns", ip="10.5.1.2", labels={"app": "nvidia-dcgm-exporter"}))
+    r = _new_reloader_with_pods(monkeypatch, pods)
+
+    built = []
+    original_from_dict = vector_config_reloader_app.PodRecord.from_dict
+    monkeypatch.setattr(vector_config_reloader_app.PodRecord, "from_dict", lambda raw: (built.append(raw["metadata"]["name"]), original_from_dict(raw))[1])
+
+    watched_from = []
+
+    def stream(**kwargs):
+        # the first list is done when the watch starts
+        watched_from.append(kwargs["resource_version"])
+        r.request_shutdown()
+        yield from ()
+
+    monkeypatch.setattr(r, "stream_pod_events", stream)
+    asyncio.run(r.run())
+
+    assert watched_from == ["1"]
+    assert [c["_continue"] for c in r.k8s_api_client.list_calls] == [None, "2", "4"]
+    assert all(c["_preload_content"] is False and c["limit"] == 2 for c in r.k8s_api_client.list_calls)
+    # only exporter pods are turned into records
+    assert built == ["svc-cm", "dcgm"]
+
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert written_cfg["sources"]["svc_cm_scrape"]["endpoints"] == ["http://10.5.1.1:9100/metrics"]
+    assert written_cfg["sources"]["dcgm_exporter_scrape"]["endpoints"] == ["http://10.5.1.2:9400/metrics"]
+
+
+def test_watch_pod_events_reads_raw_stream(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    _bootstrap(r)
+    r.config_write_debounce_secs = 0
+    cm_pod = DummyPod("svc-w", "ns", ip="10.6.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    r.k8s_api_client._events = [
+        _pod_event("ADDED", DummyPod("other", "ns", ip="10.6.0.2"), "2"),
+        _pod_event("ADDED", cm_pod, "3"),
+        _pod_event("BOOKMARK", None, "4"),
+    ]
+
+    r.watch_pod_events()
+
+    assert r.resource_version == "4"
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert written_cfg["sources"]["svc_w_scrape"]["endpoints"] == ["http://10.6.0.1:9100/metrics"]
+
+    r.k8s_api_client._events = [{"type": "ERROR", "object": {"kind": "Status", "code": 410, "reason": "Expired", "message": "too old"}}]
+    with pytest.raises(client.ApiException) as e:
+        r.watch_pod_events()
+    assert e.value.status == 410
+
+
+def test_consolidated_custom_metrics_sources_grouped_by_scrape_settings(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.consolidate_custom_metrics_sources = True
+
+    vector_cfg = {"sources": {}, "transforms": {}, "sinks": {}}
+    eps = [
+        {"url": "http://10.7.0.1:9100/metrics", "pod_name": "svc-a-1", "scrape_interval_secs": 30, "scrape_timeout_secs": 21},
+        {"url": "http://10.7.0.2:9100/metrics", "pod_name": "svc-a-2", "scrape_interval_secs": 30, "scrape_timeout_secs": 21},
+        {"url": "http://10.7.0.3:9100/metrics", "pod_name": "svc-b-1", "scrape_interval_secs": 15, "scrape_timeout_secs": 10},
+    ]
+    r.set_custom_metrics_scrape_config(vector_cfg, eps)
+
+    assert set(vector_cfg["sources"]) == {"custom_metrics_scrape_30s_21s_metrics", "custom_metrics_scrape_15s_10s_metrics"}
+    shared = vector_cfg["sources"]["custom_metrics_scrape_30s_21s_metrics"]
+    assert shared["endpoints"] == ["http://10.7.0.1:9100/metrics", "http://10.7.0.2:9100/metrics"]
+    assert shared["endpoint_tag"] == "endpoint" and shared["instance_tag"] == "instance"
+    assert vector_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] == sorted(vector_cfg["sources"])
+
+    # changed scrape settings move the endpoint to another group
+    moved = dict(eps[2], scrape_interval_secs=30, scrape_timeout_secs=21)
+    r.set_custom_metrics_scrape_config(vector_cfg, [moved])
+    assert set(vector_cfg["sources"]) == {"custom_metrics_scrape_30s_21s_metrics"}
+    assert len(shared["endpoints"]) == 3
+
+    # removals edit the endpoint list, the shared source goes away with its last endpoint
+    r.remove_custom_metrics_scrape_config(vector_cfg, eps[0])
+    assert shared["endpoints"] == ["http://10.7.0.2:9100/metrics", "http://10.7.0.3:9100/metrics"]
+    assert "cms_gateway_custom_metrics" in vector_cfg["sinks"]
+    r.remove_custom_metrics_scrape_config(vector_cfg, eps[1])
+    r.remove_custom_metrics_scrape_config(vector_cfg, moved)
+    assert vector_cfg["sources"] == {}
+    assert vector_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] == []
+    assert "cms_gateway_custom_metrics" not in vector_cfg["sinks"]
+
+
+def test_fragments_output_mode_writes_one_file_per_exporter(monkeypatch, tmp_path):
+    cm_pods = [DummyPod(f"svc-{i}", "ns", ip=f"10.8.0.{i}", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"}) for i in range(2)]
+    dcgm_pod = DummyPod("dcgm", "ns", ip="10.8.1.1", labels={"app": "nvidia-dcgm-exporter"})
+    r = _new_reloader_with_pods(monkeypatch, cm_pods + [dcgm_pod])
+    r.config_output_mode = "fragments"
+    r.config_write_debounce_secs = 0
+    # left behind by an earlier run
+    (tmp_path / "fragment_svc_old_scrape.yaml").write_text("sources: {}\n")
+
+    _bootstrap(r)
+
+    def read_config_dir():
+        return {p.name: yaml.safe_load(p.read_text()) for p in tmp_path.glob("*.yaml") if p.name == "vector.yaml" or p.name.startswith("fragment_")}
+
+    files = read_config_dir()
+    assert set(files) == {"vector.yaml", "fragment_svc_0_scrape.yaml", "fragment_svc_1_scrape.yaml", "fragment_dcgm_exporter_scrape.yaml", "fragment_custom_metrics_sink.yaml"}
+    base = files["vector.yaml"]
+    assert set(base["sources"]) == {"host_metrics"}
+    assert base["transforms"]["enrich_node_metrics"]["inputs"] == ["host_metrics"]
+    assert "enrich_custom_metrics" not in base["transforms"]
+    assert base["sinks"]["cms_gateway_node_metrics"]["inputs"] == ["enrich_node_metrics*"]
+    assert files["fragment_dcgm_exporter_scrape.yaml"]["transforms"]["enrich_node_metrics_dcgm_exporter_scrape"]["inputs"] == ["dcgm_exporter_scrape"]
+    assert files["fragment_svc_0_scrape.yaml"]["sources"]["svc_0_scrape"]["endpoints"] == ["http://10.8.0.0:9100/metrics"]
+    assert files["fragment_svc_0_scrape.yaml"]["transforms"]["enrich_custom_metrics_svc_0_scrape"]["inputs"] == ["svc_0_scrape"]
+    assert files["fragment_custom_metrics_sink.yaml"]["sinks"]["cms_gateway_custom_metrics"]["inputs"] == ["enrich_custom_metrics_*"]
+
+    writes = []
+    original_atomic_write = FileUtils.atomic_write
+    monkeypatch.setattr(FileUtils, "atomic_write", lambda path, data: (writes.append(path), original_atomic_write(path, data)))
+
+    # removing an exporter only unlinks its own fragment
+    cm_pods[0].status.phase = "Terminating"
+    r.handle_pod_event({"type": "MODIFIED", "object": cm_pods[0]})
+    assert writes == [], writes
+    assert "fragment_svc_0_scrape.yaml" not in read_config_dir()
+
+    # adding one only writes its own fragment
+    new_pod = DummyPod("svc-2", "ns", ip="10.8.0.2", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    r.handle_pod_event({"type": "ADDED", "object": new_pod})
+    assert [p.rsplit("/", 1)[-1] for p in writes] == ["fragment_svc_2_scrape.yaml"]
+
+    # the sink fragment goes away with the last custom metrics exporter
+    for pod in (cm_pods[1], new_pod):
+        pod.status.phase = "Terminating"
+        r.handle_pod_event({"type": "MODIFIED", "object": pod})
+    assert set(read_config_dir()) == {"vector.yaml", "fragment_dcgm_exporter_scrape.yaml"}
+
+
+def test_metric_filter_annotations_add_filter_stage_before_enrichment(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.config_write_debounce_secs = 0
+    _bootstrap(r)
+
+    pod = DummyPod("svc-f", "ns", ip="10.13.0.1", ann={
+        CUSTOM_METRICS_SCRAPE_ANNOTATION: "true",
+        CUSTOM_METRICS_INCLUDE_ANNOTATION: "http_requests_*, up",
+        CUSTOM_METRICS_EXCLUDE_ANNOTATION: "http_requests_debug_*",
+    })
+    r.handle_pod_event({"type": "ADDED", "object": pod})
+
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert written_cfg["transforms"]["svc_f_scrape_filter"] == {
+        "type": "filter",
+        "inputs": ["svc_f_scrape"],
+        "condition": "match(.name, r'^(?:http_requests_.*|up)$') && !match(.name, r'^(?:http_requests_debug_.*)$')",
+    }
+    assert written_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] == ["svc_f_scrape_filter"]
+
+    # dropping the annotations takes the filter stage out again
+    pod.metadata.annotations = {CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"}
+    r.handle_pod_event({"type": "MODIFIED", "object": pod})
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert "svc_f_scrape_filter" not in written_cfg["transforms"]
+    assert written_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] == ["svc_f_scrape"]
+
+    pod.metadata.annotations[CUSTOM_METRICS_EXCLUDE_ANNOTATION] = "go_*"
+    r.handle_pod_event({"type": "MODIFIED", "object": pod})
+    pod.status.phase = "Terminating"
+    r.handle_pod_event({"type": "MODIFIED", "object": pod})
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert not any(name.startswith("svc_f_scrape") for name in list(written_cfg["sources"]) + list(written_cfg["transforms"]))
+
+
+def test_consolidated_sources_are_grouped_by_metric_filter(monkeypatch):
+    filtered = {CUSTOM_METRICS_SCRAPE_ANNOTATION: "true", CUSTOM_METRICS_EXCLUDE_ANNOTATION: "go_*"}
+    pods = [
+        DummyPod("svc-a", "ns", ip="10.14.0.1", ann=dict(filtered)),
+        DummyPod("svc-b", "ns", ip="10.14.0.2", ann=dict(filtered)),
+        DummyPod("svc-c", "ns", ip="10.14.0.3", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"}),
+    ]
+    r = _new_reloader_with_pods(monkeypatch, pods)
+    r.consolidate_custom_metrics_sources = True
+    r.config_write_debounce_secs = 0
+    _bootstrap(r)
+
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    inputs = written_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"]
+    assert len(inputs) == 2
+    filter_stage = next(name for name in inputs if name.endswith("_filter"))
+    filtered_source = written_cfg["transforms"][filter_stage]["inputs"][0]
+    assert written_cfg["sources"][filtered_source]["endpoints"] == ["http://10.14.0.1:9100/metrics", "http://10.14.0.2:9100/metrics"]
+    assert written_cfg["sources"]["custom_metrics_scrape_30s_21s_metrics"]["endpoints"] == ["http://10.14.0.3:9100/metrics"]
+
+    for pod in pods[:2]:
+        pod.status.phase = "Terminating"
+        r.handle_pod_event({"type": "MODIFIED", "object": pod})
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert filtered_source not in written_cfg["sources"]
+    assert filter_stage not in written_cfg["transforms"]
+    assert written_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] == ["custom_metrics_scrape_30s_21s_metrics"]
+
+
+def test_dcgm_metric_filter_from_reloader_config(monkeypatch, tmp_path):
+    reloader_cfg = yaml.safe_load(open(vector_config_reloader_app.RELOADER_CONFIG_PATH))
+    reloader_cfg["dcgm_metrics"]["include_metrics"] = ["DCGM_FI_DEV_GPU_UTIL", "DCGM_FI_PROF_*"]
+    (tmp_path / "reloader.yaml").write_text(yaml.safe_dump(reloader_cfg))
+    dcgm_pod = DummyPod("dcgm", "ns", ip="10.15.0.1", labels={"app": "nvidia-dcgm-exporter"})
+    r = _new_reloader_with_pods(monkeypatch, [dcgm_pod])
+    r.config_output_mode = "fragments"
+    r.config_write_debounce_secs = 0
+    _bootstrap(r)
+
+    fragment = yaml.safe_load((tmp_path / "fragment_dcgm_exporter_scrape.yaml").read_text())
+    assert fragment["transforms"]["dcgm_exporter_scrape_filter"]["condition"] == "match(.name, r'^(?:DCGM_FI_DEV_GPU_UTIL|DCGM_FI_PROF_.*)$')"
+    assert fragment["transforms"]["enrich_node_metrics_dcgm_exporter_scrape_filter"]["inputs"] == ["dcgm_exporter_scrape_filter"]
+    base = yaml.safe_load((tmp_path / "vector.yaml").read_text())
+    assert base["transforms"]["enrich_node_metrics"]["inputs"] == ["host_metrics"]
+
+    dcgm_pod.status.phase = "Terminating"
+    r.handle_pod_event({"type": "MODIFIED", "object": dcgm_pod})
+    assert not (tmp_path / "fragment_dcgm_exporter_scrape.yaml").exists()
+    assert "dcgm_exporter_scrape_filter" not in r.vector_cfg["transforms"]
+
+
+def test_invalid_metric_patterns_are_dropped(monkeypatch):
+    assert VectorConfigReloader.split_patterns("up, x')' || true || match(.name, r'") == ["up"]
+    assert VectorConfigReloader.split_patterns(["DCGM_FI_*", "a$b"]) == ["DCGM_FI_*"]
+    assert VectorConfigReloader.get_config_patterns({"include_metrics": "DCGM_FI_DEV_GPU_UTIL,DCGM_FI_PROF_*"}, "include_metrics") == [
+        "DCGM_FI_DEV_GPU_UTIL", "DCGM_FI_PROF_*"
+    ]
+    with pytest.raises(RuntimeError):
+        VectorConfigReloader.get_config_patterns({"exclude_metrics": {"DCGM_FI_*": True}}, "exclude_metrics")
+
+    r = _new_reloader_with_pods(monkeypatch, [])
+    pod = DummyPod("svc-i", "ns", ip="10.15.0.2", ann={
+        CUSTOM_METRICS_SCRAPE_ANNOTATION: "true",
+        CUSTOM_METRICS_INCLUDE_ANNOTATION: "')",
+    })
+    assert r.get_custom_metrics_endpoint_cfg(pod)["metric_filter"] is None
+
+
+def test_max_series_adds_cardinality_limit_stage(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.config_write_debounce_secs = 0
+    r.default_max_series = 500
+    _bootstrap(r)
+
+    def sample(source):
+        return metrics.REGISTRY.get_sample_value("vector_config_reloader_source_series_limit", {"source": source})
+
+    defaulted = DummyPod("svc-d", "ns", ip="10.16.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    noisy = DummyPod("svc-n", "ns", ip="10.16.0.2", ann={
+        CUSTOM_METRICS_SCRAPE_ANNOTATION: "true",
+        CUSTOM_METRICS_EXCLUDE_ANNOTATION: "go_*",
+        CUSTOM_METRICS_MAX_SERIES_ANNOTATION: "50",
+        CUSTOM_METRICS_SERIES_LIMIT_ACTION_ANNOTATION: "drop_event",
+    })
+    unlimited = DummyPod("svc-u", "ns", ip="10.16.0.3", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true", CUSTOM_METRICS_MAX_SERIES_ANNOTATION: "0"})
+    for pod in (defaulted, noisy, unlimited):
+        r.handle_pod_event({"type": "ADDED", "object": pod})
+
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    transforms = written_cfg["transforms"]
+    assert transforms["svc_d_scrape_cardinality_limit"] == {
+        "type": "tag_cardinality_limit", "inputs": ["svc_d_scrape"], "mode": "exact", "value_limit": 500, "limit_exceeded_action": "drop_tag",
+    }
+    # the limit only counts the series left after filtering
+    assert transforms["svc_n_scrape_cardinality_limit"]["inputs"] == ["svc_n_scrape_filter"]
+    assert transforms["svc_n_scrape_cardinality_limit"]["value_limit"] == 50
+    assert transforms["svc_n_scrape_cardinality_limit"]["limit_exceeded_action"] == "drop_event"
+    assert "svc_u_scrape_cardinality_limit" not in transforms
+    assert transforms[CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] == [
+        "svc_d_scrape_cardinality_limit", "svc_n_scrape_cardinality_limit", "svc_u_scrape",
+    ]
+    assert (sample("svc_d_scrape"), sample("svc_n_scrape"), sample("svc_u_scrape")) == (500, 50, None)
+    assert metrics.REGISTRY.get_sample_value("vector_config_reloader_active_scrape_sources", {"kind": "custom_metrics"}) == 3
+
+    noisy.status.phase = "Terminating"
+    r.handle_pod_event({"type": "MODIFIED", "object": noisy})
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert not any(name.startswith("svc_n_scrape") for name in written_cfg["transforms"])
+    assert sample("svc_n_scrape") is None
+
+
+def test_json_config_format_replaces_stale_yaml_config(monkeypatch, tmp_path):
+    pods = [DummyPod("svc-j", "ns", ip="10.9.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})]
+    r = _new_reloader_with_pods(monkeypatch, pods)
+    r.config_serializer = get_serializer("json")
+    # written by an earlier run in yaml format
+    (tmp_path / "vector.yaml").write_text("sources: {}\n")
+
+    _bootstrap(r)
+
+    assert not (tmp_path / "vector.yaml").exists()
+    written_cfg = json.loads((tmp_path / "vector.json").read_text())
+    assert written_cfg["sources"]["svc_j_scrape"]["endpoints"] == ["http://10.9.0.1:9100/metrics"]
+    assert written_cfg["transforms"]["enrich_node_metrics"]["source"] == r.render_enrichment_source(
+        vector_config_reloader_app.NODE_METRICS_NODEPOOL_VRL, vector_config_reloader_app.NODE_METRICS_STATIC_TAGS_VRL
+    )
+
+
+def test_yaml_serializer_keeps_literal_block_style():
+    cfg = {"transforms": {"t": {"source": LiteralStr(".a = 1\n.b = 2\n")}}}
+    for serializer in (YamlSerializer(), YamlSerializer(loader=yaml.SafeLoader, dumper=yaml.SafeDumper)):
+        data = serializer.dumps(cfg)
+        assert b"source: |" in data
+        assert serializer.loads(data) == cfg
+
+
+def test_base_config_is_parsed_once(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    loads = []
+    original_load = YamlUtils.load_yaml_config
+    monkeypatch.setattr(YamlUtils, "load_yaml_config", lambda path: (loads.append(path), original_load(path))[1])
+
+    _bootstrap(r)
+    _bootstrap(r)
+
+    assert loads == [vector_config_reloader_app.VECTOR_BASE_CONFIG_PATH]
+
+
+def test_reloader_metrics_track_events_writes_and_sources(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.config_write_debounce_secs = 0
+
+    def sample(name, labels=None):
+        return metrics.REGISTRY.get_sample_value(f"vector_config_reloader_{name}", labels or {}) or 0
+
+    writes_before, skipped_before = sample("config_writes_total"), sample("config_writes_skipped_total")
+    added_before = sample("pod_events_total", {"type": "ADDED"})
+
+    _bootstrap(r)
+    pod = DummyPod("svc-m", "ns", ip="10.10.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    r.handle_pod_event({"type": "ADDED", "object": pod})
+    r.handle_pod_event({"type": "MODIFIED", "object": pod})
+
+    assert sample("pod_events_total", {"type": "ADDED"}) == added_before + 1
+    assert sample("config_writes_total") == writes_before + 2
+    assert sample("config_writes_skipped_total") == skipped_before + 1
+    assert sample("active_scrape_sources", {"kind": "custom_metrics"}) == 1
+    assert sample("active_scrape_sources", {"kind": "dcgm"}) == 0
+    assert sample("pod_event_handling_seconds_count") >= 2
+
+
+def test_reloader_metrics_endpoint_is_scraped_by_vector(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.metrics_enabled = r.metrics_scrape = True
+    r.metrics_port = 9496
+
+    _bootstrap(r)
+
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert written_cfg["sources"]["config_reloader_metrics"]["endpoints"] == ["http://127.0.0.1:9496/metrics"]
+    assert "config_reloader_metrics" in written_cfg["transforms"]["enrich_node_metrics"]["inputs"]
+
+    server, thread = metrics.start_metrics_server("127.0.0.1", 0)
+    try:
+        body = urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics").read().decode()
+    finally:
+        server.shutdown()
+    assert "vector_config_reloader_config_writes_total" in body
+
+
+def test_run_drains_queued_events_on_shutdown(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    # a long window: only the final flush on shutdown writes the queued events
+    r.config_write_debounce_secs = 60
+    pods = [DummyPod(f"svc-q-{i}", "ns", ip=f"10.11.0.{i}", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"}) for i in range(50)]
+
+    def stream(**kwargs):
+        for i, pod in enumerate(pods):
+            yield _pod_event("ADDED", pod, str(i + 2))
+        # SIGTERM arrives while events are still queued
+        r.request_shutdown()
+
+    monkeypatch.setattr(r, "stream_pod_events", stream)
+    asyncio.run(r.run())
+
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert {f"svc_q_{i}_scrape" for i in range(50)} <= set(written_cfg["sources"])
+    assert r.event_queue.empty()
+    assert r.resource_version == "51"
+
+
+def test_config_writer_task_coalesces_events(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    # can't expire during the test, the burst is only written by the final flush
+    r.config_write_debounce_secs = 3600
+
+    writes = []
+    original_atomic_write = FileUtils.atomic_write
+    monkeypatch.setattr(FileUtils, "atomic_write", lambda path, data: (writes.append(path), original_atomic_write(path, data)))
+
+    def stream(**kwargs):
+        for i in range(20):
+            yield _pod_event("ADDED", DummyPod(f"svc-c-{i}", "ns", ip=f"10.12.0.{i}", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"}), str(i + 2))
+        # the whole burst is applied in memory without a write
+        deadline = time.monotonic() + 5
+        while len(r.vector_cfg["sources"]) < 21 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert writes == []
+        r.request_shutdown()
+
+    monkeypatch.setattr(r, "stream_pod_events", stream)
+    asyncio.run(r.run())
+
+    # the bootstrap and the whole burst go out in one write
+    assert len(writes) == 1
+    assert len(yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sources"]) == 21
+
+
+def test_failed_bootstrap_write_is_retried_without_events(monkeypatch):
+    pod = DummyPod("svc-r", "ns", ip="10.24.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    r = _new_reloader_with_pods(monkeypatch, [pod])
+    r.config_write_debounce_secs = 0.01
+    monkeypatch.setattr("vector_config_reloader_app.CONFIG_WRITE_RETRY_BASE_SECS", 0.01)
+
+    failures = []
+    original_atomic_write = FileUtils.atomic_write
+
+    def atomic_write(path, data):
+        if not failures:
+            failures.append(path)
+            raise OSError("transient")
+        original_atomic_write(path, data)
+
+    monkeypatch.setattr(FileUtils, "atomic_write", atomic_write)
+
+    written_before_shutdown = []
+
+    def stream(**kwargs):
+        # a quiet node: the watch delivers nothing
+        deadline = time.monotonic() + 5
+        while not os.path.exists(vector_config_reloader_app.VECTOR_CONFIG_PATH) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        written_before_shutdown.append(os.path.exists(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+        r.request_shutdown()
+        yield from ()
+
+    monkeypatch.setattr(r, "stream_pod_events", stream)
+    asyncio.run(r.run())
+
+    assert failures == [vector_config_reloader_app.VECTOR_CONFIG_PATH]
+    assert written_before_shutdown == [True]
+    assert "svc_r_scrape" in yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sources"]
+
+
+def test_invalid_port_and_interval_annotations_fall_back_to_defaults(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    pod = DummyPod("svc-bad", "ns", ip="10.23.0.1", ann={
+        CUSTOM_METRICS_SCRAPE_ANNOTATION: "true",
+        CUSTOM_METRICS_PORT_ANNOTATION: "http",
+        CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION: "1m",
+    })
+    cfg = r.get_custom_metrics_endpoint_cfg(pod)
+    assert cfg["url"] == "http://10.23.0.1:9100/metrics"
+    assert cfg["scrape_interval_secs"] == 30
+    pod.metadata.annotations[CUSTOM_METRICS_PORT_ANNOTATION] = "70000"
+    assert r.get_custom_metrics_endpoint_cfg(pod)["url"] == "http://10.23.0.1:9100/metrics"
+
+
+def test_event_worker_and_config_writer_survive_failures(monkeypatch):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.config_write_debounce_secs = 0.01
+    monkeypatch.setattr("vector_config_reloader_app.CONFIG_WRITE_RETRY_BASE_SECS", 0.01)
+    good = DummyPod("svc-ok", "ns", ip="10.23.0.2", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+
+    original_handle_pod_event = r.handle_pod_event
+
+    def handle_pod_event(event):
+        if event["object"].metadata.name == "svc-boom":
+            raise ValueError("boom")
+        original_handle_pod_event(event)
+
+    monkeypatch.setattr(r, "handle_pod_event", handle_pod_event)
+
+    # the first write after the bootstrap fails, the writer retries it
+    failures = []
+    original_atomic_write = FileUtils.atomic_write
+
+    def atomic_write(path, data):
+        if r.resource_version is not None and not failures:
+            failures.append(path)
+            raise OSError("disk full")
+        original_atomic_write(path, data)
+
+    monkeypatch.setattr(FileUtils, "atomic_write", atomic_write)
+
+    def _written_sources():
+        # the bootstrap write failed, there is no config file until the retry
+        if not os.path.exists(vector_config_reloader_app.VECTOR_CONFIG_PATH):
+            return {}
+        return yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sources"]
+
+    def stream(**kwargs):
+        yield _pod_event("ADDED", DummyPod("svc-boom", "ns", ip="10.23.0.3", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"}), "2")
+        yield _pod_event("ADDED", good, "3")
+        deadline = time.monotonic() + 5
+        while "svc_ok_scrape" not in _written_sources() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        r.request_shutdown()
+
+    monkeypatch.setattr(r, "stream_pod_events", stream)
+    errors_before = metrics.REGISTRY.get_sample_value("vector_config_reloader_event_handling_errors_total", {"type": "ADDED"}) or 0
+    asyncio.run(r.run())
+
+    assert failures
+    assert "svc_ok_scrape" in _written_sources()
+    assert metrics.REGISTRY.get_sample_value("vector_config_reloader_event_handling_errors_total", {"type": "ADDED"}) - errors_before == 1
+    assert r.event_queue.empty()
+
+
+class _ExporterHandler(http.server.BaseHTTPRequestHandler):
+    ready = False
+
+    def do_GET(self):
+        if self.path == "/html":
+            body, content_type = b"<html>not metrics</html>", "text/html"
+        elif self.path == "/untyped":
+            body, content_type = b"# HELP up Up.\nup 1\n", "application/octet-stream"
+        elif not type(self).ready:
+            self.send_error(503)
+            return
+        else:
+            body, content_type = b"# TYPE up gauge\nup 1\n", "text/plain; version=0.0.4"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def exporter_server():
+    handler = type("Handler", (_ExporterHandler,), {"ready": False})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _wait_for_probes(prober, timeout=5):
+    deadline = time.monotonic() + timeout
+    while prober.in_flight and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # lets the completion callback of the last probe finish
+    time.sleep(0.05)
+
+
+def test_endpoint_prober_checks_prometheus_text_and_caches_results(exporter_server):
+    prober = EndpointProber(timeout_secs=1, max_concurrency=2, retries=0, backoff_secs=0, cache_ttl_secs=60)
+    base_url = f"http://127.0.0.1:{exporter_server.server_port}"
+    try:
+        assert prober.probe_once(f"{base_url}/metrics") == (False, "status")
+        assert prober.probe_once(f"{base_url}/html") == (False, "not_prometheus")
+        # no prometheus content type, but the body is a text exposition
+        assert prober.probe_once(f"{base_url}/untyped") == (True, None)
+        assert prober.probe_once("http://127.0.0.1:1/metrics")[0] is False
+
+        exporter_server.RequestHandlerClass.ready = True
+        assert prober.get_cached("uid-1", "127.0.0.1", f"{base_url}/metrics") is None
+        assert prober.probe("uid-1", "127.0.0.1", f"{base_url}/metrics", "custom_metrics") == (True, None)
+        assert prober.get_cached("uid-1", "127.0.0.1", f"{base_url}/metrics") is True
+        # a new ip or endpoint of the same pod is probed again
+        assert prober.get_cached("uid-1", "127.0.0.2", f"{base_url}/metrics") is None
+        assert prober.get_cached("uid-1", "127.0.0.1", f"{base_url}/other") is None
+        prober.forget("uid-1")
+        assert prober.get_cached("uid-1", "127.0.0.1", f"{base_url}/metrics") is None
+    finally:
+        prober.shutdown()
+
+
+def test_unready_exporters_are_added_once_their_probe_passes(monkeypatch, exporter_server):
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.config_write_debounce_secs = 0
+    r.endpoint_prober = EndpointProber(timeout_secs=1, max_concurrency=2, retries=0, backoff_secs=0, cache_ttl_secs=60)
+    _bootstrap(r)
+
+    def sample(name, labels=None):
+        return metrics.REGISTRY.get_sample_value(f"vector_config_reloader_{name}", labels or {}) or 0
+
+    rejected_before = sample("endpoint_probe_rejections_total", {"kind": "custom_metrics", "reason": "status"})
+    pod = DummyPod("svc-late", "ns", ip="127.0.0.1", ann={
+        CUSTOM_METRICS_SCRAPE_ANNOTATION: "true",
+        CUSTOM_METRICS_PORT_ANNOTATION: str(exporter_server.server_port),
+    })
+    try:
+        r.handle_pod_event({"type": "ADDED", "object": pod})
+        _wait_for_probes(r.endpoint_prober)
+        written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+        assert "svc_late_scrape" not in written_cfg["sources"]
+        assert set(r.unready_exporters) == {pod.metadata.uid}
+        assert sample("endpoint_probe_rejections_total", {"kind": "custom_metrics", "reason": "status"}) == rejected_before + 1
+
+        # status updates within the cache TTL don't probe the failing endpoint again
+        r.handle_pod_event({"type": "MODIFIED", "object": pod})
+        assert not r.endpoint_prober.in_flight
+
+        # the exporter comes up late, the periodic recheck probes it again
+        exporter_server.RequestHandlerClass.ready = True
+        r.probe_exporter(pod)
+        _wait_for_probes(r.endpoint_prober)
+        written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+        assert written_cfg["sources"]["svc_late_scrape"]["endpoints"] == [f"http://127.0.0.1:{exporter_server.server_port}/metrics"]
+        assert not r.unready_exporters
+    finally:
+        r.endpoint_prober.shutdown()
+
+
+def _write_reloader_cfg(tmp_path, **overrides):
+    reloader_cfg = yaml.safe_load(open(vector_config_reloader_app.RELOADER_CONFIG_PATH))
+    reloader_cfg.update(overrides)
+    (tmp_path / "reloader.yaml").write_text(yaml.safe_dump(reloader_cfg))
+
+
+def test_nodepool_is_rendered_as_static_tag_from_node_name(monkeypatch):
+    monkeypatch.setenv("NODE_NAME", "np-3f2a9c-7.cluster.local")
+    r = _new_reloader_with_pods(monkeypatch, [DummyPod("svc-t", "ns", ip="10.17.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})])
+    _bootstrap(r)
+
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    for transform_name in ("enrich_node_metrics", CUSTOM_METRICS_VECTOR_TRANSFORM_NAME):
+        source = written_cfg["transforms"][transform_name]["source"]
+        assert '.tags.nodepool = "np-3f2a9c"' in source
+        assert "split(" not in source
+    assert '.tags.crusoe_resource = "custom_metrics"' in written_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["source"]
+
+
+def test_nodepool_falls_back_to_per_event_parsing(monkeypatch):
+    monkeypatch.setenv("NODE_NAME", "standalone")
+    r = _new_reloader_with_pods(monkeypatch, [])
+    _bootstrap(r)
+
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert written_cfg["transforms"]["enrich_node_metrics"]["source"] == vector_config_reloader_app.NODE_METRICS_VECTOR_TRANSFORM_SOURCE
+
+
+def test_node_label_tags_follow_node_label_changes(monkeypatch, tmp_path):
+    _write_reloader_cfg(tmp_path, node_tags={"labels": {"nodepool": "crusoe.ai/nodepool.id", "gpu_type": "crusoe.ai/gpu.type"}})
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.config_write_debounce_secs = 0.01
+    r.k8s_api_client._node = {"metadata": {"name": "test-node", "resourceVersion": "1", "labels": {"crusoe.ai/nodepool.id": "pool-a", "crusoe.ai/gpu.type": "h100"}}}
+    r.k8s_api_client._node_events = [{"type": "MODIFIED", "object": {"metadata": {
+        "name": "test-node", "resourceVersion": "2", "labels": {"crusoe.ai/nodepool.id": "pool-b", "crusoe.ai/gpu.type": "h100"},
+    }}}]
+
+    def stream(**kwargs):
+        deadline = time.monotonic() + 5
+        while r.node_tags.get("nodepool") != "pool-b" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        r.request_shutdown()
+        yield from ()
+
+    monkeypatch.setattr(r, "stream_pod_events", stream)
+    asyncio.run(r.run())
+
+    assert r.node_tags == {"nodepool": "pool-b", "gpu_type": "h100"}
+    source = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["transforms"]["enrich_node_metrics"]["source"]
+    assert '.tags.gpu_type = "h100"\n.tags.nodepool = "pool-b"\n' in source
+    assert "split(" not in source
+
+
+def test_custom_metrics_sink_settings_from_reloader_config(monkeypatch, tmp_path):
+    _write_reloader_cfg(tmp_path, sink={
+        "endpoint": "https://cms-monitoring.example.com/ingest",
+        "batch": {"max_bytes": 1000000},
+        "buffer": {"type": "disk", "max_size": 536870912, "when_full": "block"},
+    })
+    r = _new_reloader_with_pods(monkeypatch, [DummyPod("svc-s", "ns", ip="10.18.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})])
+    _bootstrap(r)
+
+    sink = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sinks"]["cms_gateway_custom_metrics"]
+    assert sink["batch"] == {"max_bytes": 1000000}
+    assert sink["buffer"] == {"type": "disk", "max_size": 536870912, "when_full": "block"}
+    assert "request" not in sink
+
+
+def test_auto_sink_tuning_scales_with_scrape_sources(monkeypatch, tmp_path):
+    _write_reloader_cfg(tmp_path, sink={"endpoint": "https://cms-monitoring.example.com/ingest", "tuning": "auto", "request": {"timeout_secs": 30}})
+    r = _new_reloader_with_pods(monkeypatch, [])
+    r.config_write_debounce_secs = 0
+    _bootstrap(r)
+
+    def read_sink():
+        return yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sinks"]["cms_gateway_custom_metrics"]
+
+    r.handle_pod_event({"type": "ADDED", "object": DummyPod("svc-0", "ns", ip="10.19.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})})
+    small = read_sink()
+    assert small["batch"] == {"max_bytes": 500000, "timeout_secs": 1}
+    assert small["request"] == {"concurrency": "adaptive", "adaptive_concurrency": {"initial_concurrency": 1}, "timeout_secs": 30}
+    # 300s of one exporter scraped every 30s
+    assert small["buffer"] == {"type": "memory", "max_events": 16384, "when_full": "block"}
+
+    busy = {CUSTOM_METRICS_SCRAPE_ANNOTATION: "true", CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION: "5"}
+    for i in range(1, 200):
+        r.handle_pod_event({"type": "ADDED", "object": DummyPod(f"svc-{i}", "ns", ip=f"10.19.1.{i}", ann=busy)})
+    large = read_sink()
+    assert large["batch"]["max_bytes"] == 4 * 1024 * 1024
+    assert large["request"]["adaptive_concurrency"]["initial_concurrency"] == 1
+    # backlog of a gateway slowdown no longer fits in memory
+    assert large["buffer"]["type"] == "disk"
+    assert large["buffer"]["max_size"] == 2 * 1024 * 1024 * 1024
+    assert large["buffer"]["when_full"] == "block"
+
+
+def test_auto_sink_tuning_rounds_to_powers_of_two():
+    tuning = VectorConfigReloader.get_auto_sink_tuning(0)
+    assert tuning["batch"]["max_bytes"] == 500000
+    assert tuning["buffer"] == {"type": "memory", "max_events": 500, "when_full": "block"}
+    # one more exporter doesn't change the sink
+    assert VectorConfigReloader.get_auto_sink_tuning(40) == VectorConfigReloader.get_auto_sink_tuning(40.2)
+    saturated = VectorConfigReloader.get_auto_sink_tuning(1000)
+    assert saturated["batch"]["max_bytes"] == 8 * 1024 * 1024
+    assert saturated["request"]["adaptive_concurrency"]["initial_concurrency"] == 8
+
+
+def _new_central_reloader(monkeypatch, tmp_path, pods, **central_cfg):
+    _write_reloader_cfg(tmp_path, central=central_cfg)
+    r = CentralConfigReloader()
+    r.k8s_api_client._pods = pods
+    r.published = []
+
+    def replace_namespaced_config_map(name, namespace, body):
+        r.published.append((name, namespace, body["data"]))
+
+    r.k8s_api_client.replace_namespaced_config_map = replace_namespaced_config_map
+    return r
+
+
+def _scheduled_pod(name, node_name, ip, **kwargs):
+    pod = DummyPod(name, "ns", ip=ip, **kwargs)
+    pod.spec.node_name = node_name
+    return pod
+
+
+def test_central_reloader_publishes_per_node_configs_by_shard(monkeypatch, tmp_path):
+    pods = [
+        _scheduled_pod("svc-a", "node-a", "10.0.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"}),
+        _scheduled_pod("dcgm-b", "node-b", "10.0.0.2", labels={"app": "nvidia-dcgm-exporter"}),
+    ]
+    r = _new_central_reloader(monkeypatch, tmp_path, pods, shards=4, leader_election=False)
+    assert r.list_node_exporter_pods()[0] and r.k8s_api_client.list_calls[-1]["field_selector"] == "status.phase=Running"
+    _bootstrap(r)
+
+    # every shard is published once, each node's config lives in its node's shard
+    assert sorted(name for name, _, _ in r.published) == [f"vector-node-configs-{shard}" for shard in range(4)]
+    published = {name: data for name, _, data in r.published}
+    node_a_cfg = yaml.safe_load(published[r.get_node_config_map_name(r.get_shard("node-a"))]["node-a.yaml"])
+    node_b_cfg = yaml.safe_load(published[r.get_node_config_map_name(r.get_shard("node-b"))]["node-b.yaml"])
+    assert node_a_cfg["sources"]["svc_a_scrape"]["endpoints"] == ["http://10.0.0.1:9100/metrics"]
+    assert "dcgm_exporter_scrape" not in node_a_cfg["sources"]
+    assert node_b_cfg["sources"]["dcgm_exporter_scrape"]["endpoints"] == ["http://10.0.0.2:9400/metrics"]
+    assert "svc_a_scrape" not in node_b_cfg["sources"]
+
+    # a pod event only republishes the shard of its node
+    r.published.clear()
+    pod = _scheduled_pod("svc-c", "node-b", "10.0.0.3", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    r.dispatch_event({"type": "ADDED", "object": PodRecord.from_dict(_pod_to_dict(pod))})
+    r.write_config()
+    assert [name for name, _, _ in r.published] == [r.get_node_config_map_name(r.get_shard("node-b"))]
+    assert "svc_c_scrape" in yaml.safe_load(r.published[0][2]["node-b.yaml"])["sources"]
+
+    # nodes that are gone are dropped, new nodes get the base config
+    r.published.clear()
+    r.dispatch_event({"type": "NODE_SYNC", "object": {"node-b": {}, "node-c": {}}})
+    r.write_config()
+    published = {}
+    for _, _, data in r.published:
+        published.update(data)
+    assert "node-a.yaml" not in r.render_node_configs()
+    assert set(yaml.safe_load(published["node-c.yaml"])["sources"]) == {"host_metrics"}
+
+    # a shard above the ConfigMap limit isn't published, the others still are and the write fails loudly
+    r.published.clear()
+    monkeypatch.setattr("central_reloader.NODE_CONFIG_MAP_MAX_BYTES", len(r.published_shards[r.get_shard("node-b")]["node-b.yaml"]) + 100)
+    for i in range(4):
+        pod = _scheduled_pod(f"svc-big-{i}", "node-b", f"10.0.1.{i}", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+        r.dispatch_event({"type": "ADDED", "object": PodRecord.from_dict(_pod_to_dict(pod))})
+    r.dispatch_event({"type": "NODE_SYNC", "object": {"node-b": {}, "node-c": {}, "node-d": {}}})
+    with pytest.raises(RuntimeError, match=r.get_node_config_map_name(r.get_shard("node-b"))):
+        r.write_config()
+    assert r.get_node_config_map_name(r.get_shard("node-b")) not in [name for name, _, _ in r.published]
+    assert r.config_dirty
+
+
+def test_central_reloader_creates_missing_config_maps_and_writes_files(monkeypatch, tmp_path):
+    pods = [_scheduled_pod("svc-a", "node-a", "10.0.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})]
+    r = _new_central_reloader(monkeypatch, tmp_path, pods, shards=1, leader_election=False)
+    created = []
+
+    def replace_namespaced_config_map(name, namespace, body):
+        raise client.ApiException(status=404)
+
+    r.k8s_api_client.replace_namespaced_config_map = replace_namespaced_config_map
+    r.k8s_api_client.create_namespaced_config_map = lambda namespace, body: created.append((namespace, body["metadata"]["name"]))
+    _bootstrap(r)
+    assert created == [("crusoe-system", "vector-node-configs-0")]
+
+    output_dir = tmp_path / "nodes"
+    output_dir.mkdir()
+    (output_dir / "node-gone.yaml").write_text("{}")
+    r = _new_central_reloader(monkeypatch, tmp_path, pods, output="files", output_dir=str(output_dir), leader_election=False)
+    _bootstrap(r)
+    assert sorted(p.name for p in output_dir.iterdir()) == ["node-a.yaml"]
+    assert "svc_a_scrape" in yaml.safe_load((output_dir / "node-a.yaml").read_text())["sources"]
+
+
+def test_checkpoint_warm_start_writes_nothing_when_unchanged(monkeypatch, tmp_path):
+    checkpoint_path = tmp_path / "state" / "checkpoint.json"
+    _write_reloader_cfg(tmp_path, checkpoint={"enabled": True, "path": str(checkpoint_path)})
+    pod = DummyPod("svc-w", "ns", ip="10.9.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    _bootstrap(_new_reloader_with_pods(monkeypatch, [pod]))
+    checkpoint = json.loads(checkpoint_path.read_text())
+    assert [exporter["metadata"]["uid"] for exporter in checkpoint["exporters"]] == ["uid-ns-svc-w"]
+    assert checkpoint["resource_version"] is None and checkpoint["config_hash"]
+
+    writes = []
+    original_atomic_write = FileUtils.atomic_write
+    monkeypatch.setattr(FileUtils, "atomic_write", lambda path, data: (writes.append(path), original_atomic_write(path, data)))
+
+    # restart with the same exporters: no vector config or checkpoint write
+    checkpoint_path.write_text(json.dumps(dict(checkpoint, resource_version="7")))
+    r = _new_reloader_with_pods(monkeypatch, [pod])
+    _bootstrap(r)
+    assert writes == []
+    assert r.k8s_api_client.list_calls[-1]["resource_version"] == "7"
+    assert r.k8s_api_client.list_calls[-1]["resource_version_match"] == "NotOlderThan"
+
+    # the watch moved on: the resourceVersion alone is only saved once the refresh interval passed
+    r.resource_version = "42"
+    r.refresh_checkpoint()
+    assert writes == []
+    r.checkpoint_saved_at -= vector_config_reloader_app.CHECKPOINT_REFRESH_INTERVAL_SECS
+    r.refresh_checkpoint()
+    assert writes == [str(checkpoint_path)]
+    assert json.loads(checkpoint_path.read_text())["resource_version"] == "42"
+
+    # replaced agent pod with a new config dir: the first write comes after the list dropped the gone pod
+    os.unlink(vector_config_reloader_app.VECTOR_CONFIG_PATH)
+    r = _new_reloader_with_pods(monkeypatch, [])
+    _bootstrap(r)
+    assert "svc_w_scrape" not in yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sources"]
+    assert json.loads(checkpoint_path.read_text())["exporters"] == []
+
+    # a checkpoint of another reloader config is not restored
+    _write_reloader_cfg(tmp_path, checkpoint={"enabled": True, "path": str(checkpoint_path)}, log_level="DEBUG")
+    assert _new_reloader_with_pods(monkeypatch, []).restore_checkpoint() is False
+
+
+def test_checkpoint_warm_start_with_node_label_tags_writes_once(monkeypatch, tmp_path):
+    checkpoint_path = tmp_path / "state" / "checkpoint.json"
+    _write_reloader_cfg(tmp_path, checkpoint={"enabled": True, "path": str(checkpoint_path)},
+                        node_tags={"labels": {"nodepool": "crusoe.ai/nodepool.id"}})
+    pod = DummyPod("svc-l", "ns", ip="10.9.1.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    writes = []
+    original_atomic_write = FileUtils.atomic_write
+    monkeypatch.setattr(FileUtils, "atomic_write", lambda path, data: (writes.append(os.path.basename(path)), original_atomic_write(path, data)))
+
+    def run_reloader():
+        r = _new_reloader_with_pods(monkeypatch, [pod])
+        r.config_write_debounce_secs = 0.01
+        r.k8s_api_client._node = {"metadata": {"name": "test-node", "resourceVersion": "1", "labels": {"crusoe.ai/nodepool.id": "pool-a"}}}
+        config_writes = []
+        original_write_config = r.write_config
+        monkeypatch.setattr(r, "write_config", lambda: (config_writes.append(1), original_write_config()))
+
+        def stream(**kwargs):
+            # the first write waits for both the pod and the node list
+            deadline = time.monotonic() + 5
+            while not config_writes and time.monotonic() < deadline:
+                time.sleep(0.01)
+            r.request_shutdown()
+            yield from ()
+
+        monkeypatch.setattr(r, "stream_pod_events", stream)
+        asyncio.run(r.run())
+        return r
+
+    run_reloader()
+    # the config is written once, with the node label tag
+    assert writes == ["vector.yaml", "checkpoint.json"]
+    written_cfg = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))
+    assert '.tags.nodepool = "pool-a"' in written_cfg["transforms"]["enrich_node_metrics"]["source"]
+    assert "svc_l_scrape" in written_cfg["sources"]
+    assert json.loads(checkpoint_path.read_text())["node_tags"] == {"nodepool": "pool-a"}
+
+    # restarts with unchanged exporters and labels don't touch vector.yaml or the checkpoint
+    writes.clear()
+    r = run_reloader()
+    run_reloader()
+    assert writes == []
+    assert r.written_config_files is not None
+
+
+def test_deleted_and_deleting_pods_remove_their_scrape_config(monkeypatch):
+    cm_pod = DummyPod("svc-x", "ns", ip="10.20.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    old_dcgm = DummyPod("dcgm-old", "ns", ip="10.20.0.2", labels={"app": "nvidia-dcgm-exporter"})
+    r = _new_reloader_with_pods(monkeypatch, [cm_pod, old_dcgm])
+    r.config_write_debounce_secs = 0
+    _bootstrap(r)
+
+    # a pod being deleted is still Running until its containers stopped
+    cm_pod.metadata.deletion_timestamp = "2025-01-01T00:00:00Z"
+    r.handle_pod_event({"type": "MODIFIED", "object": cm_pod})
+    assert "svc_x_scrape" not in yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sources"]
+    assert "uid-ns-svc-x" not in r.exporter_pods
+
+    # the DCGM exporter rollout starts the new pod before the old one is deleted
+    new_dcgm = DummyPod("dcgm-new", "ns", ip="10.20.0.3", labels={"app": "nvidia-dcgm-exporter"})
+    r.handle_pod_event({"type": "ADDED", "object": new_dcgm})
+    r.handle_pod_event({"type": "DELETED", "object": old_dcgm})
+    sources = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sources"]
+    assert sources["dcgm_exporter_scrape"]["endpoints"] == ["http://10.20.0.3:9400/metrics"]
+
+    r.handle_pod_event({"type": "DELETED", "object": new_dcgm})
+    assert "dcgm_exporter_scrape" not in yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sources"]
+
+
+def test_reconciliation_removes_stale_sources_in_one_write(monkeypatch):
+    gone = DummyPod("svc-gone", "ns", ip="10.21.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    renamed = DummyPod("svc-old-name", "ns", ip="10.21.0.2", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    r = _new_reloader_with_pods(monkeypatch, [gone, renamed])
+    r.config_write_debounce_secs = 0
+    _bootstrap(r)
+    r.resource_version = "5"
+
+    # the deletions were missed: svc-gone's IP is reused by a new pod and svc-old-name came back under a new name
+    reused_ip = DummyPod("svc-reused", "ns", ip="10.21.0.1", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    new_name = DummyPod("svc-new-name", "ns", ip="10.21.0.3", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    r.k8s_api_client._pods = [reused_ip, new_name]
+    pods = r.list_reconcile_pods()
+    assert r.k8s_api_client.list_calls[-1]["resource_version"] == "5"
+
+    # events applied while the list was in flight win over the list
+    late = DummyPod("svc-late", "ns", ip="10.21.0.4", ann={CUSTOM_METRICS_SCRAPE_ANNOTATION: "true"})
+    r.config_write_debounce_secs = 1
+    r.handle_pod_event({"type": "ADDED", "object": late})
+    r.handle_pod_event({"type": "DELETED", "object": PodRecord.from_dict(_pod_to_dict(new_name))})
+
+    writes = []
+    original_atomic_write = FileUtils.atomic_write
+    monkeypatch.setattr(FileUtils, "atomic_write", lambda path, data: (writes.append(path), original_atomic_write(path, data)))
+    before = metrics.REGISTRY.get_sample_value("vector_config_reloader_reconciled_sources_total", {"action": "removed"}) or 0
+    r.dispatch_event({"type": "RECONCILE", "object": pods})
+    r.flush_config()
+
+    assert len(writes) == 1
+    sources = yaml.safe_load(open(vector_config_reloader_app.VECTOR_CONFIG_PATH))["sources"]
+    assert set(sources) == {"host_metrics", "svc_reused_scrape", "svc_late_scrape"}
+    assert set(r.exporter_pods) == {"uid-ns-svc-reused", "uid-ns-svc-late"}
+    assert metrics.REGISTRY.get_sample_value("vector_config_reloader_reconciled_sources_total", {"action": "removed"}) - before == 2
+
+    # nothing drifted, nothing is written
+    writes.clear()
+    r.k8s_api_client._pods = [reused_ip, late]
+    r.reconcile_sources(r.list_reconcile_pods())
+    r.flush_config()
+    assert writes == []
+
+
+def test_downsample_stage_aggregates_gauges_and_passes_counters(monkeypatch, tmp_path):
+    reloader_cfg = yaml.safe_load(open(vector_config_reloader_app.RELOADER_CONFIG_PATH))
+    reloader_cfg["dcgm_metrics"]["downsample"] = {"interval_secs": 60, "mode": "avg"}
+    _write_reloader_cfg(tmp_path, dcgm_metrics=reloader_cfg["dcgm_metrics"])
+    dcgm_pod = DummyPod("dcgm", "ns", ip="10.22.0.1", labels={"app": "nvidia-dcgm-exporter"})
+    pod = DummyPod("svc-ds", "ns", ip="10.22.0.2", ann={
+        CUSTOM_METRICS_SCRAPE_ANNOTATION: "true",
+        CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION: "10",
+        CUSTOM_METRICS_INCLUDE_ANNOTATION: "gpu_*",
+        CUSTOM_METRICS_DOWNSAMPLE_INTERVAL_ANNOTATION: "60",
+        CUSTOM_METRICS_DOWNSAMPLE_MODE_ANNOTATION: "max",
+    })
+    r = _new_reloader_with_pods(monkeypatch, [dcgm_pod, pod])
+    r.config_output_mode = "fragments"
+    r.config_write_debounce_secs = 0
+    _bootstrap(r)
+
+    transforms = yaml.safe_load((tmp_path / "fragment_svc_ds_scrape.yaml").read_text())["transforms"]
+    assert transforms["svc_ds_scrape_downsample_route"] == {
+        "type": "route", "inputs": ["svc_ds_scrape_filter"], "route": {"gauge": '.type == "gauge"'},
+    }
+    assert transforms["svc_ds_scrape_downsample_aggregate"] == {
+        "type": "aggregate", "inputs": ["svc_ds_scrape_downsample_route.gauge"], "interval_ms": 60000, "mode": "Max",
+    }
+    assert transforms["svc_ds_scrape_downsample"]["inputs"] == ["svc_ds_scrape_downsample_aggregate", "svc_ds_scrape_downsample_route._unmatched"]
+    assert transforms["enrich_custom_metrics_svc_ds_scrape_downsample"]["inputs"] == ["svc_ds_scrape_downsample"]
+    dcgm_transforms = yaml.safe_load((tmp_path / "fragment_dcgm_exporter_scrape.yaml").read_text())["transforms"]
+    assert dcgm_transforms["dcgm_exporter_scrape_downsample_aggregate"]["mode"] == "Mean"
+    assert r.vector_cfg["transforms"]["enrich_node_metrics"]["inputs"] == ["host_metrics", "dcgm_exporter_scrape_downsample"]
+
+    # a window that isn't above the scrape interval is ignored, and so is an unknown mode
+    assert r.get_downsample("pod x", "10", "median", 10) == {"downsample_interval_secs": 0, "downsample_mode": "last"}
+
+    pod.status.phase = "Succeeded"
+    r.handle_pod_event({"type": "MODIFIED", "object": pod})
+    assert not any(name.startswith("svc_ds_scrape") for name in r.vector_cfg["transforms"])
+    assert not (tmp_path / "fragment_svc_ds_scrape.yaml").exists()
@@ -1,22 +1,93 @@
+import contextlib, hashlib, json, os, tempfile
 import yaml
 
+# libyaml bindings are an order of magnitude faster, fall back to the pure python implementation when missing
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
 class LiteralStr(str): pass
 
 def literal_str_representer(dumper, data):
-    return dumper.represent_scalar("tag:yaml.org,2002:str", data, style="|")
+    # libyaml only accepts exact str instances
+    return dumper.represent_scalar("tag:yaml.org,2002:str", str(data), style="|")
 
-# Register representer for both default Dumper and SafeDumper used by yaml.safe_dump
+# Register representer for both default Dumper and SafeDumper used by yaml.safe_dump, plus the libyaml SafeDumper
 yaml.Dumper.add_representer(LiteralStr, literal_str_representer)
 yaml.SafeDumper.add_representer(LiteralStr, literal_str_representer)
+SafeDumper.add_representer(LiteralStr, literal_str_representer)
+
+class FileUtils:
+    @staticmethod
+    def sha256_digest(path: str):
+        try:
+            with open(path, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def atomic_write(path: str, data: bytes):
+        # write to a temp file in the same dir and rename it into place, so readers never see a partial file
+        dir_name = os.path.dirname(path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def write_if_changed(path: str, data: bytes) -> bool:
+        if hashlib.sha256(data).hexdigest() == FileUtils.sha256_digest(path):
+            return False
+        FileUtils.atomic_write(path, data)
+        return True
+
+class YamlSerializer:
+    extension = "yaml"
+
+    def __init__(self, loader=SafeLoader, dumper=SafeDumper):
+        self.loader = loader
+        self.dumper = dumper
+
+    def loads(self, data) -> dict:
+        return dict(yaml.load(data, Loader=self.loader))
+
+    def dumps(self, cfg: dict) -> bytes:
+        return yaml.dump(cfg, Dumper=self.dumper).encode("utf-8")
+
+class JsonSerializer:
+    """Vector reads .json configs natively, dumping JSON is much cheaper than YAML. VRL sources stay plain strings."""
+    extension = "json"
+
+    def loads(self, data) -> dict:
+        return dict(json.loads(data))
+
+    def dumps(self, cfg: dict) -> bytes:
+        # no indent, that keeps json on the C encoder
+        return json.dumps(cfg, sort_keys=True).encode("utf-8")
+
+SERIALIZERS = {
+    "yaml": YamlSerializer,
+    "json": JsonSerializer,
+}
+
+def get_serializer(config_format: str):
+    if config_format not in SERIALIZERS:
+        raise RuntimeError(f"Unknown vector config format {config_format}, expected one of {sorted(SERIALIZERS)}")
+    return SERIALIZERS[config_format]()
 
 class YamlUtils:
     @staticmethod
     def load_yaml_config(path: str) -> dict:
         with open(path) as f:
-            cfg = dict(yaml.safe_load(f))
+            cfg = dict(yaml.load(f, Loader=SafeLoader))
         return cfg
-
-    @staticmethod
-    def save_yaml(path: str, cfg: dict):
-        with open(path, "w") as f:
-            yaml.safe_dump(cfg, f)
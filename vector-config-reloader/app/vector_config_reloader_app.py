@@ -1,6 +1,12 @@
-import os, signal, re, logging, sys
-from kubernetes import client, config, watch
-from utils import LiteralStr, YamlUtils
+import asyncio, copy, hashlib, json, math, os, random, signal, re, logging, sys, threading, time
+import urllib3
+from urllib.parse import urlsplit
+from kubernetes import client, config
+from kubernetes.watch.watch import iter_resp_lines
+import metrics
+from pods import PodRecord
+from probes import EndpointProber
+from utils import SERIALIZERS, FileUtils, LiteralStr, YamlUtils, get_serializer
 
 VECTOR_CONFIG_PATH = "/etc/vector/vector.yaml"
 VECTOR_BASE_CONFIG_PATH = "/etc/vector-base/vector.yaml"
@@ -9,8 +15,10 @@ RELOADER_CONFIG_PATH = "/etc/reloader/config.yaml"
 DCGM_EXPORTER_SOURCE_NAME = "dcgm_exporter_scrape"
 DCGM_EXPORTER_APP_LABEL = "nvidia-dcgm-exporter"
 NODE_METRICS_VECTOR_TRANSFORM_NAME = "enrich_node_metrics"
-NODE_METRICS_VECTOR_TRANSFORM_SOURCE = LiteralStr("""
-if exists(.tags.Hostname) {
+NODE_METRICS_SINK_NAME = "cms_gateway_node_metrics"
+CUSTOM_METRICS_SINK_NAME = "cms_gateway_custom_metrics"
+# per event nodepool parsing, only rendered when the reloader couldn't work out the node's nodepool itself
+NODE_METRICS_NODEPOOL_VRL = """if exists(.tags.Hostname) {
 parts, _ = split(.tags.Hostname, ".")
 host_prefix = get(parts, [0]) ?? ""
 prefix_parts, _ = split(host_prefix, "-")
@@ -21,35 +29,125 @@ prefix_parts, _ = split(.tags.host, "-")
 nodepool_id_parts, _ = slice(prefix_parts, 0, length(prefix_parts) - 1)
 .tags.nodepool, _ = join(nodepool_id_parts, "-")
 }
-.tags.cluster_id = "${CRUSOE_CLUSTER_ID}"
+"""
+NODE_METRICS_STATIC_TAGS_VRL = """.tags.cluster_id = "${CRUSOE_CLUSTER_ID}"
 .tags.vm_id = "${VM_ID}"
 .tags.crusoe_resource = "vm"
-""")
+"""
+NODE_METRICS_VECTOR_TRANSFORM_SOURCE = LiteralStr("\n" + NODE_METRICS_NODEPOOL_VRL + NODE_METRICS_STATIC_TAGS_VRL)
+NODEPOOL_TAG = "nodepool"
+NODE_TAG_NAME_PATTERN = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+# prometheus metric name characters plus the "*" wildcard, anything else could break out of the VRL regex literal
+METRIC_NAME_PATTERN = re.compile(r"^[a-zA-Z0-9_:*]+$")
 CUSTOM_METRICS_VECTOR_TRANSFORM_NAME = "enrich_custom_metrics"
 CUSTOM_METRICS_SCRAPE_ANNOTATION = "crusoe.custom_metrics.enable_scrape"
 CUSTOM_METRICS_PORT_ANNOTATION = "crusoe.custom_metrics.port"
 CUSTOM_METRICS_PATH_ANNOTATION = "crusoe.custom_metrics.path"
 CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION = f"crusoe.custom_metrics.scrape_interval"
-CUSTOM_METRICS_VECTOR_TRANSFORM = {
-    "type": "remap",
-    "inputs": [],
-    "source": LiteralStr("""
-if exists(.tags.Hostname) {
+# comma separated metric name patterns, "*" matches any run of characters
+CUSTOM_METRICS_INCLUDE_ANNOTATION = "crusoe.custom_metrics.include_metrics"
+CUSTOM_METRICS_EXCLUDE_ANNOTATION = "crusoe.custom_metrics.exclude_metrics"
+# distinct values kept per tag of a custom metrics source, and what happens to metrics past the limit
+CUSTOM_METRICS_MAX_SERIES_ANNOTATION = "crusoe.custom_metrics.max_series"
+CUSTOM_METRICS_SERIES_LIMIT_ACTION_ANNOTATION = "crusoe.custom_metrics.series_limit_action"
+SERIES_LIMIT_ACTIONS = ("drop_tag", "drop_event")
+DEFAULT_SERIES_LIMIT_ACTION = "drop_tag"
+# window (seconds) gauges of a custom metrics source are aggregated over before they are shipped, and how
+CUSTOM_METRICS_DOWNSAMPLE_INTERVAL_ANNOTATION = "crusoe.custom_metrics.downsample_interval"
+CUSTOM_METRICS_DOWNSAMPLE_MODE_ANNOTATION = "crusoe.custom_metrics.downsample_mode"
+# downsample mode -> vector aggregate transform mode
+DOWNSAMPLE_MODES = {"last": "Latest", "avg": "Mean", "max": "Max"}
+DEFAULT_DOWNSAMPLE_MODE = "last"
+METRIC_FILTER_STAGE_SUFFIX = "_filter"
+DOWNSAMPLE_STAGE_SUFFIX = "_downsample"
+CARDINALITY_LIMIT_STAGE_SUFFIX = "_cardinality_limit"
+# per source transforms chained between a scrape source and its enrichment transform, in pipeline order
+SOURCE_STAGE_SUFFIXES = (METRIC_FILTER_STAGE_SUFFIX, DOWNSAMPLE_STAGE_SUFFIX, CARDINALITY_LIMIT_STAGE_SUFFIX)
+# the downsample stage routes gauges through an aggregate transform and joins them with the passed through counters
+DOWNSAMPLE_ROUTE_SUFFIX = "_route"
+DOWNSAMPLE_AGGREGATE_SUFFIX = "_aggregate"
+DOWNSAMPLE_GAUGE_ROUTE = "gauge"
+CONSOLIDATED_CUSTOM_METRICS_SOURCE_PREFIX = "custom_metrics_scrape"
+SCRAPE_ENDPOINT_TAG = "endpoint"
+SCRAPE_INSTANCE_TAG = "instance"
+CUSTOM_METRICS_NODEPOOL_VRL = """if exists(.tags.Hostname) {
 parts, _ = split(.tags.Hostname, ".")
 host_prefix = get(parts, [0]) ?? ""
 prefix_parts, _ = split(host_prefix, "-")
 nodepool_id_parts, _ = slice(prefix_parts, 0, length(prefix_parts) - 1)
 .tags.nodepool, _ = join(nodepool_id_parts, "-")
 }
-.tags.cluster_id = "${CRUSOE_CLUSTER_ID}"
+"""
+CUSTOM_METRICS_STATIC_TAGS_VRL = """.tags.cluster_id = "${CRUSOE_CLUSTER_ID}"
 .tags.vm_id = "${VM_ID}"
 .tags.crusoe_resource = "custom_metrics"
-""")
+"""
+CUSTOM_METRICS_VECTOR_TRANSFORM = {
+    "type": "remap",
+    "inputs": [],
+    "source": LiteralStr("\n" + CUSTOM_METRICS_NODEPOOL_VRL + CUSTOM_METRICS_STATIC_TAGS_VRL)
 }
 
 SCRAPE_INTERVAL_MIN_THRESHOLD = 5
 SCRAPE_TIMEOUT_PERCENTAGE = 0.7
 MAX_EVENT_WATCHER_RETRIES = 5
+WATCH_TIMEOUT_SECS = 300
+WATCH_REQUEST_TIMEOUT_GRACE_SECS = 30
+WATCH_BACKOFF_BASE_SECS = 1
+WATCH_BACKOFF_MAX_SECS = 60
+HTTP_STATUS_GONE = 410
+POD_LIST_PAGE_SIZE = 500
+CONFIG_OUTPUT_MODE_SINGLE = "single"
+CONFIG_OUTPUT_MODE_FRAGMENTS = "fragments"
+CONFIG_FRAGMENT_FILE_PREFIX = "fragment_"
+CUSTOM_METRICS_SINK_FRAGMENT_NAME = f"{CONFIG_FRAGMENT_FILE_PREFIX}custom_metrics_sink"
+DEFAULT_CONFIG_WRITE_DEBOUNCE_SECS = 2
+CONFIG_WRITE_RETRY_BASE_SECS = 1
+CONFIG_WRITE_RETRY_MAX_SECS = 60
+EVENT_QUEUE_MAX_SIZE = 10000
+SYNC_EVENT_TYPE = "SYNC"
+NODE_LABELS_EVENT_TYPE = "NODE_LABELS"
+RELOADER_METRICS_SOURCE_NAME = "config_reloader_metrics"
+RELOADER_METRICS_TRANSFORM_NAME = "add_internal_labels"
+DEFAULT_RELOADER_METRICS_PORT = 9496
+DEFAULT_RELOADER_METRICS_ADDRESS = "127.0.0.1"
+RELOADER_METRICS_POD_IP_ADDRESS = "pod_ip"
+RELOADER_METRICS_SCRAPE_INTERVAL_SECS = 60
+EXPORTER_READY_EVENT_TYPE = "EXPORTER_READY"
+RECONCILE_EVENT_TYPE = "RECONCILE"
+DEFAULT_RECONCILE_INTERVAL_SECS = 300
+DEFAULT_PROBE_TIMEOUT_SECS = 2
+DEFAULT_PROBE_MAX_CONCURRENCY = 8
+DEFAULT_PROBE_RETRIES = 3
+DEFAULT_PROBE_BACKOFF_SECS = 1
+DEFAULT_PROBE_CACHE_TTL_SECS = 300
+DEFAULT_PROBE_RECHECK_INTERVAL_SECS = 30
+SINK_TUNING_STATIC = "static"
+SINK_TUNING_AUTO = "auto"
+SINK_TUNING_SECTIONS = ("batch", "request", "buffer")
+# auto sizing assumes a scrape yields this many samples, at about this many bytes each in a remote-write request
+AUTO_SINK_SAMPLES_PER_SCRAPE = 1000
+AUTO_SINK_BYTES_PER_SAMPLE = 100
+AUTO_SINK_BATCH_TIMEOUT_SECS = 1
+# the VM configs' max_bytes
+AUTO_SINK_MIN_BATCH_BYTES = 500000
+AUTO_SINK_MAX_BATCH_BYTES = 8 * 1024 * 1024
+AUTO_SINK_REQUEST_RTT_SECS = 0.5
+AUTO_SINK_MAX_INITIAL_CONCURRENCY = 32
+# gateway slowdown the buffer absorbs before it blocks the scrapes, memory buffers are only used while that fits
+AUTO_SINK_BUFFER_SECS = 300
+AUTO_SINK_MEMORY_BYTES_PER_EVENT = 512
+AUTO_SINK_MAX_MEMORY_BUFFER_BYTES = 64 * 1024 * 1024
+AUTO_SINK_MIN_MEMORY_BUFFER_EVENTS = 500
+# vector's minimum disk buffer size
+AUTO_SINK_MIN_DISK_BUFFER_BYTES = 268435488
+AUTO_SINK_MAX_DISK_BUFFER_BYTES = 4 * 1024 * 1024 * 1024
+DEFAULT_CHECKPOINT_PATH = "/var/lib/vector-config-reloader/checkpoint.json"
+CHECKPOINT_VERSION = 1
+# the warm start list is served from the API server's watch cache instead of a quorum read from etcd
+CHECKPOINT_LIST_RESOURCE_VERSION_MATCH = "NotOlderThan"
+# an unchanged checkpoint is still rewritten this often to move its resourceVersion forward
+CHECKPOINT_REFRESH_INTERVAL_SECS = 300
 
 logging.basicConfig(
     level=logging.INFO,  # overridden later by config's log_level
@@ -59,22 +157,50 @@ logging.basicConfig(
 LOG = logging.getLogger(__name__)
 
 class VectorConfigReloader:
-    def __init__(self):
-        self.node_name = os.environ.get("NODE_NAME")
+    def __init__(self, node_name: str = None, k8s_api_client=None, reloader_cfg: dict = None):
+        # the central reloader passes the node, its API client and config to the per node renderers
+        self.node_name = node_name or os.environ.get("NODE_NAME")
         if not self.node_name:
             raise RuntimeError("NODE_NAME not set")
 
         self.running = True
-        config.load_incluster_config()
-        self.k8s_api_client = client.CoreV1Api()
-        self.k8s_event_watcher = watch.Watch()
+        self.resource_version = None
+        self.watch_failures = 0
+        if k8s_api_client is None:
+            config.load_incluster_config()
+            k8s_api_client = client.CoreV1Api()
+        self.k8s_api_client = k8s_api_client
 
-        reloader_cfg = YamlUtils.load_yaml_config(RELOADER_CONFIG_PATH)
+        if reloader_cfg is None:
+            reloader_cfg = YamlUtils.load_yaml_config(RELOADER_CONFIG_PATH)
         self.dcgm_exporter_port = reloader_cfg["dcgm_metrics"]["port"]
         self.dcgm_exporter_path = reloader_cfg["dcgm_metrics"]["path"]
         self.dcgm_exporter_scrape_interval = reloader_cfg["dcgm_metrics"]["scrape_interval"]
+        self.dcgm_exporter_metric_filter = VectorConfigReloader.get_metric_filter_condition(
+            VectorConfigReloader.get_config_patterns(reloader_cfg["dcgm_metrics"], "include_metrics"),
+            VectorConfigReloader.get_config_patterns(reloader_cfg["dcgm_metrics"], "exclude_metrics")
+        )
+        dcgm_downsample_cfg = reloader_cfg["dcgm_metrics"].get("downsample") or {}
+        self.dcgm_exporter_downsample = self.get_downsample(
+            DCGM_EXPORTER_SOURCE_NAME, dcgm_downsample_cfg.get("interval_secs"), dcgm_downsample_cfg.get("mode"), self.dcgm_exporter_scrape_interval
+        )
         self.default_custom_metrics_config = reloader_cfg["custom_metrics"]
+        # cluster default of the downsample annotations, an interval of 0 ships every scraped sample
+        self.default_downsample_cfg = self.default_custom_metrics_config.get("downsample") or {}
+        # merge pods sharing scrape settings into one multi-endpoint source instead of one source per pod
+        self.consolidate_custom_metrics_sources = bool(self.default_custom_metrics_config.get("consolidate_sources", False))
+        # cluster default of the max_series annotation, 0 leaves sources unlimited
+        self.default_max_series = int(self.default_custom_metrics_config.get("max_series") or 0)
+        self.default_series_limit_action = self.default_custom_metrics_config.get("series_limit_action", DEFAULT_SERIES_LIMIT_ACTION)
+        if self.default_series_limit_action not in SERIES_LIMIT_ACTIONS:
+            raise RuntimeError(f"Unknown custom_metrics.series_limit_action {self.default_series_limit_action}, expected one of {SERIES_LIMIT_ACTIONS}")
         self.sink_endpoint = reloader_cfg["sink"]["endpoint"]
+        # tag name -> node label, node constant tags are rendered into the enrichment transforms as static values
+        self.node_label_tags = dict((reloader_cfg.get("node_tags") or {}).get("labels") or {})
+        for tag in self.node_label_tags:
+            if not NODE_TAG_NAME_PATTERN.match(tag):
+                raise RuntimeError(f"Invalid node_tags.labels tag name {tag}")
+        self.node_tags = self.get_node_tags({})
         self.custom_metrics_sink_config = {
             "type": "prometheus_remote_write",
             "inputs": [CUSTOM_METRICS_VECTOR_TRANSFORM_NAME],
@@ -84,6 +210,87 @@ class VectorConfigReloader:
             "compression": "snappy",
             "tls": {"verify_certificate": True, "verify_hostname": True},
         }
+        # batch/request/buffer of the custom metrics sink, "auto" sizes them from the active scrape sources on
+        # every write and the configured sections override the sized ones
+        self.sink_tuning_mode = reloader_cfg["sink"].get("tuning", SINK_TUNING_STATIC)
+        if self.sink_tuning_mode not in (SINK_TUNING_STATIC, SINK_TUNING_AUTO):
+            raise RuntimeError(f"Unknown sink.tuning {self.sink_tuning_mode}")
+        self.sink_tuning_overrides = {section: reloader_cfg["sink"][section] for section in SINK_TUNING_SECTIONS if reloader_cfg["sink"].get(section)}
+        self.custom_metrics_sink_config.update(copy.deepcopy(self.sink_tuning_overrides))
+
+        # desired vector config is kept in memory, pod events are coalesced into a single write per debounce window
+        self.vector_cfg = None
+        self.vector_cfg_lock = threading.Lock()
+        # serializes the config writer task with the final flush on shutdown
+        self.config_write_lock = threading.Lock()
+        self.config_dirty = False
+        vector_config = reloader_cfg.get("vector_config", {})
+        self.config_write_debounce_secs = float(vector_config.get("debounce_secs", DEFAULT_CONFIG_WRITE_DEBOUNCE_SECS))
+        # sweeps sources of pods whose events were missed, 0 disables it
+        self.reconcile_interval_secs = float(vector_config.get("reconcile_interval_secs", DEFAULT_RECONCILE_INTERVAL_SECS))
+        # uids of pods whose events were applied while a reconciliation list was in flight, None when there is none
+        self.reconcile_touched_uids = None
+        # in fragments mode every exporter lives in its own file of the vector config dir
+        self.config_output_mode = vector_config.get("output_mode", CONFIG_OUTPUT_MODE_SINGLE)
+        if self.config_output_mode not in (CONFIG_OUTPUT_MODE_SINGLE, CONFIG_OUTPUT_MODE_FRAGMENTS):
+            raise RuntimeError(f"Unknown vector_config.output_mode {self.config_output_mode}")
+        self.config_serializer = get_serializer(vector_config.get("format", "yaml"))
+        self.base_vector_cfg = None
+        # file name -> config last written to it, None for files found on disk at startup
+        self.written_config_files = None
+
+        metrics_cfg = reloader_cfg.get("metrics", {})
+        self.metrics_enabled = bool(metrics_cfg.get("enabled", False))
+        self.metrics_port = int(metrics_cfg.get("port", DEFAULT_RELOADER_METRICS_PORT))
+        self.metrics_address = metrics_cfg.get("listen_address", DEFAULT_RELOADER_METRICS_ADDRESS)
+        if self.metrics_address == RELOADER_METRICS_POD_IP_ADDRESS:
+            self.metrics_address = os.environ.get("POD_IP")
+            if not self.metrics_address:
+                raise RuntimeError("metrics.listen_address is pod_ip but POD_IP not set")
+        # lets vector ship the reloader's own metrics with the node's internal metrics
+        self.metrics_scrape = self.metrics_enabled and bool(metrics_cfg.get("scrape", True))
+
+        # optional pre-flight check that an exporter serves Prometheus text before its scrape source is added
+        readiness_probe_cfg = reloader_cfg.get("readiness_probe", {})
+        self.endpoint_prober = None
+        if readiness_probe_cfg.get("enabled", False):
+            self.endpoint_prober = EndpointProber(
+                timeout_secs=float(readiness_probe_cfg.get("timeout_secs", DEFAULT_PROBE_TIMEOUT_SECS)),
+                max_concurrency=int(readiness_probe_cfg.get("max_concurrency", DEFAULT_PROBE_MAX_CONCURRENCY)),
+                retries=int(readiness_probe_cfg.get("retries", DEFAULT_PROBE_RETRIES)),
+                backoff_secs=float(readiness_probe_cfg.get("backoff_secs", DEFAULT_PROBE_BACKOFF_SECS)),
+                cache_ttl_secs=float(readiness_probe_cfg.get("cache_ttl_secs", DEFAULT_PROBE_CACHE_TTL_SECS)),
+            )
+        self.readiness_recheck_interval_secs = float(readiness_probe_cfg.get("recheck_interval_secs", DEFAULT_PROBE_RECHECK_INTERVAL_SECS))
+        # pod uid -> running exporter pod whose endpoint hasn't passed the readiness probe yet
+        self.unready_exporters = {}
+        # pod uid -> exporter pod with a scrape config in vector_cfg
+        self.exporter_pods = {}
+
+        # the known exporters, resourceVersion and hash of the rendered config are saved on a node local volume, a
+        # restarted or replaced reloader renders from them right away and only applies what changed since
+        checkpoint_cfg = reloader_cfg.get("checkpoint", {})
+        self.checkpoint_path = checkpoint_cfg.get("path", DEFAULT_CHECKPOINT_PATH) if checkpoint_cfg.get("enabled", False) else None
+        # a checkpoint rendered with another reloader or base config is not reused
+        self.checkpoint_fingerprint = hashlib.sha256(
+            json.dumps(reloader_cfg, sort_keys=True, default=str).encode() + (FileUtils.sha256_digest(VECTOR_BASE_CONFIG_PATH) or "").encode()
+        ).hexdigest() if self.checkpoint_path else None
+        self.checkpoint_resource_version = None
+        # (exporter uids and ips, config hash) last saved, the checkpoint is only rewritten when they change or its
+        # resourceVersion is older than CHECKPOINT_REFRESH_INTERVAL_SECS
+        self.saved_checkpoint_state = None
+        self.saved_checkpoint_resource_version = None
+        self.checkpoint_saved_at = 0.0
+
+        # asyncio plumbing, set up by run(): watch thread -> bounded event queue -> event worker -> config writer
+        self.loop = None
+        self.event_queue = None
+        self.config_dirty_event = None
+        self.shutdown_event = None
+        self.watch_responses = set()
+        # event types of the first lists run() waits for before the first write, so a (warm) start doesn't write a
+        # config that the next list changes again
+        self.initial_sync_pending = set()
 
         LOG.setLevel(reloader_cfg["log_level"])
 
@@ -94,11 +301,8 @@ class VectorConfigReloader:
 
     @staticmethod
     def is_pod_active(pod):
-        return pod.status.phase == "Running"
-
-    @staticmethod
-    def is_pod_terminating(pod):
-        return pod.status.phase == "Terminating"
+        # a pod that is being deleted keeps its Running phase until its containers stopped
+        return pod.status.phase == "Running" and pod.metadata.deletion_timestamp is None
 
     @staticmethod
     def is_custom_metrics_pod(pod):
@@ -110,8 +314,25 @@ class VectorConfigReloader:
         labels = pod.metadata.labels or {}
         return labels and "app" in labels and labels["app"] == DCGM_EXPORTER_APP_LABEL
 
-    def handle_sigterm(self, sig, frame):
-        self.running = False
+    @staticmethod
+    def is_metrics_exporter_pod_dict(raw_pod: dict):
+        # runs on the raw API server JSON so irrelevant pods are dropped before any object is built
+        metadata = raw_pod.get("metadata") or {}
+        return (metadata.get("annotations") or {}).get(CUSTOM_METRICS_SCRAPE_ANNOTATION) == "true" \
+            or (metadata.get("labels") or {}).get("app") == DCGM_EXPORTER_APP_LABEL
+
+    @staticmethod
+    def get_exporter_kind(pod):
+        if VectorConfigReloader.is_custom_metrics_pod(pod):
+            return "custom_metrics"
+        if VectorConfigReloader.is_dcgm_exporter_pod(pod):
+            return "dcgm"
+        return None
+
+    def get_exporter_scrape_endpoint(self, pod) -> str:
+        if VectorConfigReloader.is_custom_metrics_pod(pod):
+            return self.get_custom_metrics_endpoint_cfg(pod)["url"]
+        return self.get_dcgm_exporter_scrape_endpoint(pod.status.pod_ip)
 
     def get_dcgm_exporter_scrape_endpoint(self, pod_ip) -> str:
         return f"http://{pod_ip}:{self.dcgm_exporter_port}{self.dcgm_exporter_path}"
@@ -120,9 +341,20 @@ class VectorConfigReloader:
         pod_ip = pod.status.pod_ip
         pod_name = pod.metadata.name
         annotations = pod.metadata.annotations
-        port = int(annotations.get(CUSTOM_METRICS_PORT_ANNOTATION, self.default_custom_metrics_config["port"]))
+        port = int(self.default_custom_metrics_config["port"])
+        try:
+            port = int(annotations.get(CUSTOM_METRICS_PORT_ANNOTATION, port))
+        except ValueError:
+            LOG.warning(f"For pod {pod_name}, invalid {CUSTOM_METRICS_PORT_ANNOTATION}: {annotations[CUSTOM_METRICS_PORT_ANNOTATION]}, defaulting to {port}")
+        if not 0 < port < 65536:
+            LOG.warning(f"For pod {pod_name}, {CUSTOM_METRICS_PORT_ANNOTATION} {port} out of range, defaulting to {self.default_custom_metrics_config['port']}")
+            port = int(self.default_custom_metrics_config["port"])
         path = annotations.get(CUSTOM_METRICS_PATH_ANNOTATION, self.default_custom_metrics_config["path"])
-        interval = int(annotations.get(CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION, self.default_custom_metrics_config["scrape_interval"]))
+        interval = int(self.default_custom_metrics_config["scrape_interval"])
+        try:
+            interval = int(annotations.get(CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION, interval))
+        except ValueError:
+            LOG.warning(f"For pod {pod_name}, invalid {CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION}: {annotations[CUSTOM_METRICS_SCRAPE_INTERVAL_ANNOTATION]}, defaulting to {interval}")
         if interval < SCRAPE_INTERVAL_MIN_THRESHOLD:
             LOG.warning(f"For pod {pod_name}, scrape interval set to: {interval} (less than 5 seconds), defaulting to {SCRAPE_INTERVAL_MIN_THRESHOLD}")
             interval = SCRAPE_INTERVAL_MIN_THRESHOLD
@@ -130,9 +362,181 @@ class VectorConfigReloader:
             "url": f"http://{pod_ip}:{port}{path}",
             "pod_name": pod_name,
             "scrape_interval_secs": interval,
-            "scrape_timeout_secs": int(interval * SCRAPE_TIMEOUT_PERCENTAGE)
+            "scrape_timeout_secs": int(interval * SCRAPE_TIMEOUT_PERCENTAGE),
+            "metric_filter": VectorConfigReloader.get_metric_filter_condition(
+                VectorConfigReloader.split_patterns(annotations.get(CUSTOM_METRICS_INCLUDE_ANNOTATION), f"pod {pod_name}"),
+                VectorConfigReloader.split_patterns(annotations.get(CUSTOM_METRICS_EXCLUDE_ANNOTATION), f"pod {pod_name}")
+            ),
+            **self.get_series_limit(pod_name, annotations),
+            **self.get_downsample(
+                f"pod {pod_name}",
+                annotations.get(CUSTOM_METRICS_DOWNSAMPLE_INTERVAL_ANNOTATION, self.default_downsample_cfg.get("interval_secs")),
+                annotations.get(CUSTOM_METRICS_DOWNSAMPLE_MODE_ANNOTATION, self.default_downsample_cfg.get("mode")),
+                interval
+            )
+        }
+
+    def get_series_limit(self, pod_name: str, annotations: dict) -> dict:
+        max_series, action = self.default_max_series, self.default_series_limit_action
+        try:
+            max_series = int(annotations.get(CUSTOM_METRICS_MAX_SERIES_ANNOTATION, max_series))
+        except ValueError:
+            LOG.warning(f"For pod {pod_name}, invalid {CUSTOM_METRICS_MAX_SERIES_ANNOTATION}: {annotations[CUSTOM_METRICS_MAX_SERIES_ANNOTATION]}, defaulting to {max_series}")
+        if annotations.get(CUSTOM_METRICS_SERIES_LIMIT_ACTION_ANNOTATION) in SERIES_LIMIT_ACTIONS:
+            action = annotations[CUSTOM_METRICS_SERIES_LIMIT_ACTION_ANNOTATION]
+        elif CUSTOM_METRICS_SERIES_LIMIT_ACTION_ANNOTATION in annotations:
+            LOG.warning(f"For pod {pod_name}, invalid {CUSTOM_METRICS_SERIES_LIMIT_ACTION_ANNOTATION}: {annotations[CUSTOM_METRICS_SERIES_LIMIT_ACTION_ANNOTATION]}, defaulting to {action}")
+        return {"max_series": max(max_series, 0), "series_limit_action": action}
+
+    @staticmethod
+    def get_downsample(owner: str, interval_secs, mode, scrape_interval_secs: int) -> dict:
+        """Downsample settings of a source, an interval of 0 leaves it at scrape resolution."""
+        try:
+            interval_secs = int(interval_secs or 0)
+        except ValueError:
+            LOG.warning(f"For {owner}, invalid downsample interval: {interval_secs}, not downsampling")
+            interval_secs = 0
+        mode = mode or DEFAULT_DOWNSAMPLE_MODE
+        if mode not in DOWNSAMPLE_MODES:
+            LOG.warning(f"For {owner}, invalid downsample mode: {mode}, defaulting to {DEFAULT_DOWNSAMPLE_MODE}")
+            mode = DEFAULT_DOWNSAMPLE_MODE
+        if 0 < interval_secs <= scrape_interval_secs:
+            # every window holds at most one sample, aggregating it would only delay it
+            LOG.warning(f"For {owner}, downsample interval {interval_secs}s is not above the scrape interval {scrape_interval_secs}s, not downsampling")
+            interval_secs = 0
+        return {"downsample_interval_secs": max(interval_secs, 0), "downsample_mode": mode}
+
+    @staticmethod
+    def split_patterns(value, owner: str = "metric filter") -> list:
+        """Comma separated (or already split) metric name patterns, dropping the ones that aren't valid."""
+        if isinstance(value, str) or value is None:
+            value = (value or "").split(",")
+        patterns = []
+        for pattern in value:
+            pattern = str(pattern).strip()
+            if not pattern:
+                continue
+            if not METRIC_NAME_PATTERN.match(pattern):
+                LOG.warning(f"For {owner}, invalid metric name pattern: {pattern}, ignoring it")
+                continue
+            patterns.append(pattern)
+        return patterns
+
+    @staticmethod
+    def get_config_patterns(metrics_cfg: dict, key: str) -> list:
+        value = metrics_cfg.get(key)
+        if value is not None and not isinstance(value, (str, list)):
+            raise RuntimeError(f"Invalid dcgm_metrics.{key} {value}, expected a list or a comma separated string")
+        return VectorConfigReloader.split_patterns(value, f"dcgm_metrics.{key}")
+
+    @staticmethod
+    def get_metric_name_regex(patterns: list) -> str:
+        alternatives = sorted({".*".join(re.escape(part) for part in pattern.split("*")) for pattern in patterns})
+        return f"^(?:{'|'.join(alternatives)})$"
+
+    @staticmethod
+    def get_metric_filter_condition(include_patterns, exclude_patterns):
+        """VRL condition keeping the metrics matched by include_patterns (all if empty) and not by exclude_patterns."""
+        conditions = []
+        if include_patterns:
+            conditions.append(f"match(.name, r'{VectorConfigReloader.get_metric_name_regex(include_patterns)}')")
+        if exclude_patterns:
+            conditions.append(f"!match(.name, r'{VectorConfigReloader.get_metric_name_regex(exclude_patterns)}')")
+        return " && ".join(conditions) or None
+
+    @staticmethod
+    def get_source_stages(metric_filter=None, max_series=0, series_limit_action=DEFAULT_SERIES_LIMIT_ACTION,
+                          downsample_interval_secs=0, downsample_mode=DEFAULT_DOWNSAMPLE_MODE) -> dict:
+        stages = {}
+        if metric_filter:
+            stages[METRIC_FILTER_STAGE_SUFFIX] = {"type": "filter", "condition": metric_filter}
+        if downsample_interval_secs:
+            # expanded into the route/aggregate/join transforms by set_source_stages
+            stages[DOWNSAMPLE_STAGE_SUFFIX] = {
+                "type": "aggregate",
+                "interval_ms": downsample_interval_secs * 1000,
+                "mode": DOWNSAMPLE_MODES[downsample_mode],
+            }
+        if max_series:
+            stages[CARDINALITY_LIMIT_STAGE_SUFFIX] = {
+                "type": "tag_cardinality_limit",
+                "mode": "exact",
+                "value_limit": max_series,
+                "limit_exceeded_action": series_limit_action,
+            }
+        return stages
+
+    @staticmethod
+    def get_custom_metrics_source_stages(custom_metrics_ep: dict) -> dict:
+        return VectorConfigReloader.get_source_stages(
+            custom_metrics_ep.get("metric_filter"),
+            custom_metrics_ep.get("max_series", 0),
+            custom_metrics_ep.get("series_limit_action", DEFAULT_SERIES_LIMIT_ACTION),
+            custom_metrics_ep.get("downsample_interval_secs", 0),
+            custom_metrics_ep.get("downsample_mode", DEFAULT_DOWNSAMPLE_MODE)
+        )
+
+    @staticmethod
+    def get_source_component_names(source_name: str) -> list:
+        downsample_stage_name = f"{source_name}{DOWNSAMPLE_STAGE_SUFFIX}"
+        return [source_name] + [f"{source_name}{suffix}" for suffix in SOURCE_STAGE_SUFFIXES] + [
+            f"{downsample_stage_name}{DOWNSAMPLE_ROUTE_SUFFIX}", f"{downsample_stage_name}{DOWNSAMPLE_AGGREGATE_SUFFIX}"
+        ]
+
+    @staticmethod
+    def get_downsample_transforms(stage_name: str, upstream: str, aggregate: dict) -> dict:
+        """Aggregates the gauges over the window, counters (absolute in a scrape) and histograms pass through."""
+        route_name = f"{stage_name}{DOWNSAMPLE_ROUTE_SUFFIX}"
+        aggregate_name = f"{stage_name}{DOWNSAMPLE_AGGREGATE_SUFFIX}"
+        return {
+            route_name: {"type": "route", "inputs": [upstream], "route": {DOWNSAMPLE_GAUGE_ROUTE: '.type == "gauge"'}},
+            aggregate_name: dict(aggregate, inputs=[f"{route_name}.{DOWNSAMPLE_GAUGE_ROUTE}"]),
+            # joins both paths again, so the stage still has a single output like the other stages
+            stage_name: {"type": "remap", "inputs": [aggregate_name, f"{route_name}._unmatched"], "source": "."},
         }
 
+    @staticmethod
+    def set_source_stages(vector_cfg: dict, source_name: str, stages: dict) -> str:
+        """Chains the stages (suffix -> transform) after the source, returns the component the enrichment reads from."""
+        transforms = vector_cfg.setdefault("transforms", {})
+        upstream = source_name
+        for suffix in SOURCE_STAGE_SUFFIXES:
+            stage_name = f"{source_name}{suffix}"
+            if suffix == DOWNSAMPLE_STAGE_SUFFIX:
+                stage_transforms = VectorConfigReloader.get_downsample_transforms(stage_name, upstream, stages[suffix]) if suffix in stages else {}
+                for name in (f"{stage_name}{DOWNSAMPLE_ROUTE_SUFFIX}", f"{stage_name}{DOWNSAMPLE_AGGREGATE_SUFFIX}"):
+                    if name not in stage_transforms:
+                        transforms.pop(name, None)
+                transforms.update(stage_transforms)
+            if suffix not in stages:
+                transforms.pop(stage_name, None)
+                continue
+            if suffix != DOWNSAMPLE_STAGE_SUFFIX:
+                transforms[stage_name] = dict(stages[suffix], inputs=[upstream])
+            upstream = stage_name
+        return upstream
+
+    @staticmethod
+    def remove_source(vector_cfg: dict, inputs: set, source_name: str):
+        """Removes a scrape source, its stages and whichever of them the enrichment transform read from."""
+        vector_cfg.get("sources", {}).pop(source_name, None)
+        for component_name in VectorConfigReloader.get_source_component_names(source_name):
+            if component_name != source_name:
+                vector_cfg.get("transforms", {}).pop(component_name, None)
+            inputs.discard(component_name)
+
+    @staticmethod
+    def resolve_source_name(vector_cfg: dict, input_name: str) -> str:
+        # follows the single input chain of the source stages back to the scrape source, the downsample stage's join
+        # is followed through its aggregate transform and "<transform>.<output>" inputs to the transform
+        transforms = vector_cfg.get("transforms", {})
+        while input_name in transforms:
+            inputs = transforms[input_name].get("inputs", [])
+            if len(inputs) != 1 and not (inputs and input_name.endswith(DOWNSAMPLE_STAGE_SUFFIX)):
+                break
+            input_name = inputs[0].split(".")[0]
+        return input_name
+
     def set_dcgm_exporter_scrape_config(self, vector_cfg: dict, dcgm_exporter_scrape_endpoint: str):
         if dcgm_exporter_scrape_endpoint is None:
             return
@@ -142,122 +546,1006 @@ class VectorConfigReloader:
             "scrape_interval_secs": self.dcgm_exporter_scrape_interval,
             "scrape_timeout_secs": int(self.dcgm_exporter_scrape_interval * SCRAPE_TIMEOUT_PERCENTAGE)
         }
-        inputs = set(vector_cfg["transforms"][NODE_METRICS_VECTOR_TRANSFORM_NAME]["inputs"])
-        if DCGM_EXPORTER_SOURCE_NAME not in inputs:
-            vector_cfg["transforms"][NODE_METRICS_VECTOR_TRANSFORM_NAME]["inputs"].append(DCGM_EXPORTER_SOURCE_NAME)
+        input_name = VectorConfigReloader.set_source_stages(
+            vector_cfg, DCGM_EXPORTER_SOURCE_NAME, VectorConfigReloader.get_source_stages(self.dcgm_exporter_metric_filter, **self.dcgm_exporter_downsample)
+        )
+        inputs = vector_cfg["transforms"][NODE_METRICS_VECTOR_TRANSFORM_NAME]["inputs"]
+        stale_inputs = set(VectorConfigReloader.get_source_component_names(DCGM_EXPORTER_SOURCE_NAME)) - {input_name}
+        inputs[:] = [name for name in inputs if name not in stale_inputs]
+        if input_name not in inputs:
+            inputs.append(input_name)
 
     def remove_dcgm_exporter_scrape_config(self, vector_cfg: dict):
-        vector_cfg.get("sources", {}).pop(DCGM_EXPORTER_SOURCE_NAME, None)
         inputs = set(vector_cfg["transforms"][NODE_METRICS_VECTOR_TRANSFORM_NAME].get("inputs", []))
-        inputs.discard(DCGM_EXPORTER_SOURCE_NAME)
+        VectorConfigReloader.remove_source(vector_cfg, inputs, DCGM_EXPORTER_SOURCE_NAME)
         vector_cfg["transforms"][NODE_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] = sorted(inputs)
 
+    def get_custom_metrics_source_name(self, custom_metrics_ep: dict) -> str:
+        if not self.consolidate_custom_metrics_sources:
+            return f"{VectorConfigReloader.sanitize_name(custom_metrics_ep['pod_name'])}_scrape"
+        interval, timeout = custom_metrics_ep["scrape_interval_secs"], custom_metrics_ep["scrape_timeout_secs"]
+        path = urlsplit(custom_metrics_ep["url"]).path
+        source_name = f"{CONSOLIDATED_CUSTOM_METRICS_SOURCE_PREFIX}_{interval}s_{timeout}s{path}"
+        stages = VectorConfigReloader.get_custom_metrics_source_stages(custom_metrics_ep)
+        if stages:
+            # pods only share a source, and so its filter and limit stages, when their stages are the same
+            source_name += f"_{hashlib.sha256(json.dumps(stages, sort_keys=True).encode()).hexdigest()[:8]}"
+        return VectorConfigReloader.sanitize_name(source_name)
+
+    @staticmethod
+    def discard_consolidated_custom_metrics_endpoint(vector_cfg: dict, inputs: set, url: str):
+        sources = vector_cfg.get("sources", {})
+        for source_name in [name for name in sources if name.startswith(CONSOLIDATED_CUSTOM_METRICS_SOURCE_PREFIX)]:
+            source = sources[source_name]
+            if url not in source["endpoints"]:
+                continue
+            source["endpoints"] = [endpoint for endpoint in source["endpoints"] if endpoint != url]
+            if not source["endpoints"]:
+                VectorConfigReloader.remove_source(vector_cfg, inputs, source_name)
+
     def set_custom_metrics_scrape_config(self, vector_cfg: dict, custom_metrics_eps: list):
         if not custom_metrics_eps:
             return
         sources = vector_cfg.get("sources")
         transforms = vector_cfg.get("transforms")
-        enrich_custom_metrics = transforms.setdefault(CUSTOM_METRICS_VECTOR_TRANSFORM_NAME, CUSTOM_METRICS_VECTOR_TRANSFORM)
+        enrich_custom_metrics = transforms.get(CUSTOM_METRICS_VECTOR_TRANSFORM_NAME)
+        if enrich_custom_metrics is None:
+            enrich_custom_metrics = transforms[CUSTOM_METRICS_VECTOR_TRANSFORM_NAME] = copy.deepcopy(CUSTOM_METRICS_VECTOR_TRANSFORM)
+            enrich_custom_metrics["source"] = self.render_enrichment_source(CUSTOM_METRICS_NODEPOOL_VRL, CUSTOM_METRICS_STATIC_TAGS_VRL)
         inputs = set(enrich_custom_metrics.get("inputs", []))
 
         for endpoint in custom_metrics_eps:
-            source_name = f"{VectorConfigReloader.sanitize_name(endpoint['pod_name'])}_scrape"
-            sources[source_name] = {
-                "type": "prometheus_scrape",
-                "endpoints": [endpoint["url"]],
-                "scrape_interval_secs": endpoint["scrape_interval_secs"],
-                "scrape_timeout_secs": endpoint["scrape_timeout_secs"]
-            }
-            inputs.add(source_name)
+            source_name = self.get_custom_metrics_source_name(endpoint)
+            if self.consolidate_custom_metrics_sources:
+                # the endpoint may have moved from another group if the pod's scrape settings changed
+                VectorConfigReloader.discard_consolidated_custom_metrics_endpoint(vector_cfg, inputs, endpoint["url"])
+                source = sources.setdefault(source_name, {
+                    "type": "prometheus_scrape",
+                    "endpoints": [],
+                    "scrape_interval_secs": endpoint["scrape_interval_secs"],
+                    "scrape_timeout_secs": endpoint["scrape_timeout_secs"],
+                    # keeps per pod identity on the metrics of a shared source
+                    "endpoint_tag": SCRAPE_ENDPOINT_TAG,
+                    "instance_tag": SCRAPE_INSTANCE_TAG
+                })
+                source["endpoints"] = sorted(set(source["endpoints"]) | {endpoint["url"]})
+            else:
+                sources[source_name] = {
+                    "type": "prometheus_scrape",
+                    "endpoints": [endpoint["url"]],
+                    "scrape_interval_secs": endpoint["scrape_interval_secs"],
+                    "scrape_timeout_secs": endpoint["scrape_timeout_secs"]
+                }
+            input_name = VectorConfigReloader.set_source_stages(vector_cfg, source_name, VectorConfigReloader.get_custom_metrics_source_stages(endpoint))
+            inputs.difference_update(VectorConfigReloader.get_source_component_names(source_name))
+            inputs.add(input_name)
         enrich_custom_metrics["inputs"] = sorted(inputs)
-        vector_cfg["sinks"]["cms_gateway_custom_metrics"] = self.custom_metrics_sink_config
+        # keeps the auto sized settings of an existing sink, they are only re-sized on write
+        vector_cfg["sinks"].setdefault(CUSTOM_METRICS_SINK_NAME, self.custom_metrics_sink_config)
 
     def remove_custom_metrics_scrape_config(self, vector_cfg: dict, custom_metrics_ep: dict):
-        source_name = f"{VectorConfigReloader.sanitize_name(custom_metrics_ep['pod_name'])}_scrape"
-        vector_cfg.get("sources", {}).pop(source_name, None)
         inputs = set(vector_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME].get("inputs", []))
-        inputs.discard(source_name)
+        if self.consolidate_custom_metrics_sources:
+            VectorConfigReloader.discard_consolidated_custom_metrics_endpoint(vector_cfg, inputs, custom_metrics_ep["url"])
+        else:
+            VectorConfigReloader.remove_source(vector_cfg, inputs, self.get_custom_metrics_source_name(custom_metrics_ep))
         vector_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"] = sorted(inputs)
         if not vector_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["inputs"]:
-            vector_cfg.get("sinks", {}).pop("cms_gateway_custom_metrics", None)
+            vector_cfg.get("sinks", {}).pop(CUSTOM_METRICS_SINK_NAME, None)
+
+    def remove_exporter_scrape_config(self, vector_cfg: dict, pod):
+        """Removes the pod's scrape config, unless its source now scrapes another pod (e.g. a newer DCGM exporter)."""
+        endpoint = self.get_exporter_scrape_endpoint(pod)
+        if VectorConfigReloader.is_custom_metrics_pod(pod):
+            custom_metrics_ep = self.get_custom_metrics_endpoint_cfg(pod)
+            source = vector_cfg.get("sources", {}).get(self.get_custom_metrics_source_name(custom_metrics_ep))
+            if self.consolidate_custom_metrics_sources or (source is not None and endpoint in source["endpoints"]):
+                self.remove_custom_metrics_scrape_config(vector_cfg, custom_metrics_ep)
+        else:
+            source = vector_cfg.get("sources", {}).get(DCGM_EXPORTER_SOURCE_NAME)
+            if source is not None and endpoint in source["endpoints"]:
+                self.remove_dcgm_exporter_scrape_config(vector_cfg)
+
+    def set_exporter_scrape_config(self, vector_cfg: dict, pod):
+        if VectorConfigReloader.is_custom_metrics_pod(pod):
+            self.set_custom_metrics_scrape_config(vector_cfg, [self.get_custom_metrics_endpoint_cfg(pod)])
+        else:
+            self.set_dcgm_exporter_scrape_config(vector_cfg, self.get_dcgm_exporter_scrape_endpoint(pod.status.pod_ip))
+
+    @staticmethod
+    def is_endpoint_scraped(vector_cfg: dict, endpoint: str) -> bool:
+        return any(endpoint in source.get("endpoints", []) for source in ((vector_cfg or {}).get("sources") or {}).values())
+
+    def is_exporter_ready(self, pod) -> bool:
+        """Whether the exporter's scrape source can be added now, called with vector_cfg_lock held.
+
+        Without readiness probing every running exporter is ready. With it, exporters that haven't passed a probe
+        are parked in unready_exporters and added by an EXPORTER_READY event once a background probe succeeds.
+        """
+        if self.endpoint_prober is None:
+            return True
+        endpoint = self.get_exporter_scrape_endpoint(pod)
+        # already scraped exporters aren't probed again, the probe only guards adding them
+        if VectorConfigReloader.is_endpoint_scraped(self.vector_cfg, endpoint):
+            return True
+        ready = self.endpoint_prober.get_cached(pod.metadata.uid, pod.status.pod_ip, endpoint)
+        if ready:
+            self.unready_exporters.pop(pod.metadata.uid, None)
+            return True
+        self.unready_exporters[pod.metadata.uid] = pod
+        if ready is None:
+            self.probe_exporter(pod)
+        return False
+
+    def probe_exporter(self, pod):
+        endpoint = self.get_exporter_scrape_endpoint(pod)
+
+        def on_probed(ready, reason):
+            if ready:
+                self.enqueue_pod_event({"type": EXPORTER_READY_EVENT_TYPE, "object": pod})
+            else:
+                LOG.warning(f"Pod {pod.metadata.name} endpoint {endpoint} failed the readiness probe ({reason}), not scraping it until it is ready.")
+
+        self.endpoint_prober.submit(pod.metadata.uid, pod.status.pod_ip, endpoint, VectorConfigReloader.get_exporter_kind(pod), on_probed)
+
+    def discard_unready_exporter(self, pod):
+        if self.endpoint_prober is None:
+            return
+        self.unready_exporters.pop(pod.metadata.uid, None)
+        self.endpoint_prober.forget(pod.metadata.uid)
+
+    def handle_exporter_ready(self, pod):
+        with self.vector_cfg_lock:
+            unready_pod = self.unready_exporters.get(pod.metadata.uid)
+            # the pod may have gone away, moved or changed its endpoint while it was being probed
+            if unready_pod is None or unready_pod.status.pod_ip != pod.status.pod_ip \
+                    or self.get_exporter_scrape_endpoint(unready_pod) != self.get_exporter_scrape_endpoint(pod):
+                return
+            self.unready_exporters.pop(pod.metadata.uid)
+            self.set_exporter_scrape_config(self.vector_cfg, unready_pod)
+            self.exporter_pods[unready_pod.metadata.uid] = unready_pod
+            LOG.info(f"Pod {pod.metadata.name} endpoint passed the readiness probe, scraping it.")
+        self.schedule_config_write()
+
+    @staticmethod
+    def get_nodepool_from_node_name(node_name: str) -> str:
+        # same rule as the per event parsing: the first DNS label without its last dash separated part
+        prefix_parts = node_name.split(".")[0].split("-")
+        return "-".join(prefix_parts[:-1])
+
+    def get_node_tags(self, node_labels: dict) -> dict:
+        node_tags = {}
+        nodepool = VectorConfigReloader.get_nodepool_from_node_name(self.node_name)
+        if nodepool:
+            node_tags[NODEPOOL_TAG] = nodepool
+        for tag, label in self.node_label_tags.items():
+            if node_labels.get(label):
+                node_tags[tag] = node_labels[label]
+        return node_tags
+
+    def render_enrichment_source(self, nodepool_vrl: str, static_tags_vrl: str) -> LiteralStr:
+        node_tags_vrl = "".join(f".tags.{tag} = {json.dumps(value)}\n" for tag, value in sorted(self.node_tags.items()))
+        return LiteralStr("\n" + ("" if NODEPOOL_TAG in self.node_tags else nodepool_vrl) + node_tags_vrl + static_tags_vrl)
+
+    def set_enrichment_sources(self, vector_cfg: dict):
+        transforms = vector_cfg["transforms"]
+        transforms[NODE_METRICS_VECTOR_TRANSFORM_NAME]["source"] = self.render_enrichment_source(NODE_METRICS_NODEPOOL_VRL, NODE_METRICS_STATIC_TAGS_VRL)
+        if CUSTOM_METRICS_VECTOR_TRANSFORM_NAME in transforms:
+            transforms[CUSTOM_METRICS_VECTOR_TRANSFORM_NAME]["source"] = self.render_enrichment_source(CUSTOM_METRICS_NODEPOOL_VRL, CUSTOM_METRICS_STATIC_TAGS_VRL)
+
+    def handle_node_labels(self, node_labels: dict):
+        with self.vector_cfg_lock:
+            node_tags = self.get_node_tags(node_labels)
+            if node_tags == self.node_tags:
+                return
+            LOG.info(f"Node tags changed from {self.node_tags} to {node_tags}.")
+            self.node_tags = node_tags
+            if self.base_vector_cfg is not None:
+                self.set_enrichment_sources(self.base_vector_cfg)
+            if self.vector_cfg is not None:
+                self.set_enrichment_sources(self.vector_cfg)
+        self.schedule_config_write()
+
+    @staticmethod
+    def round_up_power_of_two(value: float) -> int:
+        # sizes move in steps, so a node gaining one more exporter rarely changes (and rebuilds) the sink
+        return 1 << max(math.ceil(value) - 1, 0).bit_length()
+
+    @staticmethod
+    def get_auto_sink_tuning(scrapes_per_sec: float) -> dict:
+        samples_per_sec = scrapes_per_sec * AUTO_SINK_SAMPLES_PER_SCRAPE
+        bytes_per_sec = samples_per_sec * AUTO_SINK_BYTES_PER_SAMPLE
+        batch_bytes = min(max(VectorConfigReloader.round_up_power_of_two(bytes_per_sec * AUTO_SINK_BATCH_TIMEOUT_SECS), AUTO_SINK_MIN_BATCH_BYTES), AUTO_SINK_MAX_BATCH_BYTES)
+        # adaptive concurrency starts where it keeps up with the expected batches instead of ramping up from 1
+        initial_concurrency = min(VectorConfigReloader.round_up_power_of_two(bytes_per_sec / batch_bytes * AUTO_SINK_REQUEST_RTT_SECS), AUTO_SINK_MAX_INITIAL_CONCURRENCY)
+        backlog_events = samples_per_sec * AUTO_SINK_BUFFER_SECS
+        if backlog_events * AUTO_SINK_MEMORY_BYTES_PER_EVENT <= AUTO_SINK_MAX_MEMORY_BUFFER_BYTES:
+            buffer = {"type": "memory", "max_events": max(VectorConfigReloader.round_up_power_of_two(backlog_events), AUTO_SINK_MIN_MEMORY_BUFFER_EVENTS)}
+        else:
+            backlog_bytes = bytes_per_sec * AUTO_SINK_BUFFER_SECS
+            buffer = {"type": "disk", "max_size": min(max(VectorConfigReloader.round_up_power_of_two(backlog_bytes), AUTO_SINK_MIN_DISK_BUFFER_BYTES), AUTO_SINK_MAX_DISK_BUFFER_BYTES)}
+        # a full buffer applies backpressure to the scrapes instead of dropping metrics
+        buffer["when_full"] = "block"
+        return {
+            "batch": {"max_bytes": batch_bytes, "timeout_secs": AUTO_SINK_BATCH_TIMEOUT_SECS},
+            "request": {"concurrency": "adaptive", "adaptive_concurrency": {"initial_concurrency": initial_concurrency}},
+            "buffer": buffer,
+        }
+
+    def set_custom_metrics_sink_tuning(self, vector_cfg: dict):
+        sink = vector_cfg.get("sinks", {}).get(CUSTOM_METRICS_SINK_NAME)
+        if self.sink_tuning_mode != SINK_TUNING_AUTO or sink is None:
+            return
+        sources = vector_cfg.get("sources", {})
+        scrapes_per_sec = 0
+        for input_name in vector_cfg["transforms"][CUSTOM_METRICS_VECTOR_TRANSFORM_NAME].get("inputs", []):
+            source = sources.get(VectorConfigReloader.resolve_source_name(vector_cfg, input_name))
+            if source is not None:
+                scrapes_per_sec += len(source["endpoints"]) / source["scrape_interval_secs"]
+        tuning = VectorConfigReloader.get_auto_sink_tuning(scrapes_per_sec)
+        tuning["batch"].update(self.sink_tuning_overrides.get("batch", {}))
+        tuning["request"].update(self.sink_tuning_overrides.get("request", {}))
+        if "buffer" in self.sink_tuning_overrides:
+            # memory and disk buffers take different settings, so a configured buffer replaces the sized one
+            tuning["buffer"] = copy.deepcopy(self.sink_tuning_overrides["buffer"])
+        if any(sink.get(section) != tuning[section] for section in SINK_TUNING_SECTIONS):
+            LOG.info(f"Custom metrics sink sized for {scrapes_per_sec:.2f} scrapes/sec: {tuning}")
+            vector_cfg["sinks"][CUSTOM_METRICS_SINK_NAME] = dict(sink, **tuning)
+
+    def set_reloader_metrics_scrape_config(self, vector_cfg: dict):
+        vector_cfg.setdefault("sources", {})[RELOADER_METRICS_SOURCE_NAME] = {
+            "type": "prometheus_scrape",
+            "endpoints": [f"http://{self.metrics_address}:{self.metrics_port}/metrics"],
+            "scrape_interval_secs": RELOADER_METRICS_SCRAPE_INTERVAL_SECS,
+            "scrape_timeout_secs": int(RELOADER_METRICS_SCRAPE_INTERVAL_SECS * SCRAPE_TIMEOUT_PERCENTAGE)
+        }
+        transform_name = RELOADER_METRICS_TRANSFORM_NAME if RELOADER_METRICS_TRANSFORM_NAME in vector_cfg["transforms"] else NODE_METRICS_VECTOR_TRANSFORM_NAME
+        inputs = vector_cfg["transforms"][transform_name].setdefault("inputs", [])
+        if RELOADER_METRICS_SOURCE_NAME not in inputs:
+            inputs.append(RELOADER_METRICS_SOURCE_NAME)
+
+    def load_base_config(self) -> dict:
+        if self.base_vector_cfg is None:
+            # the base config is only parsed once, every (re-)bootstrap starts from a copy of it
+            base_cfg = YamlUtils.load_yaml_config(VECTOR_BASE_CONFIG_PATH)
+            # set endpoint as per env
+            base_cfg["sinks"][NODE_METRICS_SINK_NAME]["endpoint"] = self.sink_endpoint
+            # always update the node metrics transform source to handle LiteralStr issue, and to render the node tags
+            self.set_enrichment_sources(base_cfg)
+            if self.metrics_scrape:
+                self.set_reloader_metrics_scrape_config(base_cfg)
+            self.base_vector_cfg = base_cfg
+        return copy.deepcopy(self.base_vector_cfg)
+
+    def list_node_exporter_pods(self):
+        # a warm start validates the checkpoint with a list at least as new as its resourceVersion
+        resource_version, self.checkpoint_resource_version = self.checkpoint_resource_version, None
+        return self.list_exporter_pods(f"{self.get_pod_field_selector()},status.phase=Running", resource_version)
 
-    def bootstrap_config(self):
-        base_cfg = YamlUtils.load_yaml_config(VECTOR_BASE_CONFIG_PATH)
+    def get_pod_field_selector(self) -> str:
+        return f"spec.nodeName={self.node_name}"
 
+    def apply_pod_list(self, pods: list):
+        with self.vector_cfg_lock:
+            # a re-list starts over, exporters that are gone aren't waited for any more
+            self.unready_exporters.clear()
+            pods = [pod for pod in pods if VectorConfigReloader.is_pod_active(pod) and self.is_exporter_ready(pod)]
+            self.exporter_pods = {pod.metadata.uid: pod for pod in pods if VectorConfigReloader.get_exporter_kind(pod) is not None}
+        base_cfg = self.render_exporter_config(pods)
+
+        with self.vector_cfg_lock:
+            self.vector_cfg = base_cfg
+        # written by the config writer, which retries a failed write
+        self.schedule_config_write()
+        LOG.info(f"Vector config bootstrapped!")
+
+    def render_exporter_config(self, pods: list) -> dict:
+        """Vector config scraping the given ready exporter pods, built on a copy of the base config."""
+        base_cfg = self.load_base_config()
         dcgm_exporter_ep = None
         custom_metrics_eps = []
-        for pod in self.k8s_api_client.list_pod_for_all_namespaces(field_selector=f"spec.nodeName={self.node_name},status.phase=Running").items:
+        for pod in pods:
             if VectorConfigReloader.is_custom_metrics_pod(pod):
                 custom_metrics_eps.append(self.get_custom_metrics_endpoint_cfg(pod))
             elif VectorConfigReloader.is_dcgm_exporter_pod(pod):
                 dcgm_exporter_ep = self.get_dcgm_exporter_scrape_endpoint(pod.status.pod_ip)
-            else:
-                LOG.info(f"Pod {pod.metadata.name} is not a relevant metrics exporter.")
 
         self.set_custom_metrics_scrape_config(base_cfg, custom_metrics_eps)
         self.set_dcgm_exporter_scrape_config(base_cfg, dcgm_exporter_ep)
+        return base_cfg
 
-        # set endpoint as per env
-        base_cfg["sinks"]["cms_gateway_node_metrics"]["endpoint"] = self.sink_endpoint
+    def list_reconcile_pods(self):
+        with self.vector_cfg_lock:
+            self.reconcile_touched_uids = set()
+        # at least as new as every event the watch delivered so far, served from the API server's watch cache
+        pods, _ = self.list_exporter_pods(f"{self.get_pod_field_selector()},status.phase=Running", self.resource_version)
+        return pods
 
-        LOG.debug(f"Writing vector config {str(base_cfg)}")
-        # always update the node metrics transform source to handle LiteralStr issue
-        base_cfg["transforms"][NODE_METRICS_VECTOR_TRANSFORM_NAME]["source"] = NODE_METRICS_VECTOR_TRANSFORM_SOURCE
-        YamlUtils.save_yaml(VECTOR_CONFIG_PATH, base_cfg)
-        LOG.info(f"Vector config bootstrapped!")
+    def reconcile_sources(self, pods: list):
+        """Re-renders the config from a fresh pod list when its scrape sources drifted from the desired exporters.
+
+        Catches sources of pods whose deletion was missed, pod IPs that were reused and renamed pods. Pods with events
+        applied after the list was taken keep their current state. All changes go out in one write.
+        """
+        with self.vector_cfg_lock:
+            touched_uids, self.reconcile_touched_uids = self.reconcile_touched_uids or set(), None
+            desired_pods = {pod.metadata.uid: pod for pod in pods if pod.metadata.uid not in touched_uids}
+            desired_pods.update((uid, pod) for uid, pod in self.exporter_pods.items() if uid in touched_uids)
+            desired_pods = {
+                uid: pod for uid, pod in desired_pods.items()
+                if VectorConfigReloader.get_exporter_kind(pod) is not None and VectorConfigReloader.is_pod_active(pod) and self.is_exporter_ready(pod)
+            }
+        desired_cfg = self.render_exporter_config(list(desired_pods.values()))
+
+        with self.vector_cfg_lock:
+            if self.vector_cfg is None:
+                return
+            rendered_sources, desired_sources = self.vector_cfg.get("sources", {}), desired_cfg.get("sources", {})
+            stale = [name for name, source in rendered_sources.items() if desired_sources.get(name) != source]
+            missing = [name for name, source in desired_sources.items() if rendered_sources.get(name) != source]
+            if not stale and not missing and self.vector_cfg.get("transforms") == desired_cfg.get("transforms"):
+                LOG.debug(f"Reconciliation found no stale scrape sources.")
+                return
+            LOG.warning(f"Reconciliation replaced stale scrape sources {sorted(stale)} and added {sorted(missing)}.")
+            metrics.RECONCILED_SOURCES.labels("removed").inc(len(stale))
+            metrics.RECONCILED_SOURCES.labels("added").inc(len(missing))
+            # the sink keeps its sized settings, they are re-sized on write
+            if CUSTOM_METRICS_SINK_NAME in desired_cfg.get("sinks", {}) and CUSTOM_METRICS_SINK_NAME in self.vector_cfg.get("sinks", {}):
+                desired_cfg["sinks"][CUSTOM_METRICS_SINK_NAME] = self.vector_cfg["sinks"][CUSTOM_METRICS_SINK_NAME]
+            self.vector_cfg = desired_cfg
+            self.exporter_pods = desired_pods
+        self.schedule_config_write()
+
+    def list_exporter_pods(self, field_selector: str, resource_version: str = None):
+        pods = []
+        continue_token = None
+        while True:
+            resp = self.k8s_api_client.list_pod_for_all_namespaces(
+                field_selector=field_selector,
+                limit=POD_LIST_PAGE_SIZE,
+                _continue=continue_token,
+                # continue tokens carry the resourceVersion of the first page
+                resource_version=None if continue_token else resource_version,
+                resource_version_match=CHECKPOINT_LIST_RESOURCE_VERSION_MATCH if resource_version and not continue_token else None,
+                _preload_content=False
+            )
+            page = json.loads(resp.data)
+            pods.extend(PodRecord.from_dict(raw_pod) for raw_pod in page.get("items") or [] if VectorConfigReloader.is_metrics_exporter_pod_dict(raw_pod))
+            continue_token = page["metadata"].get("continue")
+            if not continue_token:
+                return pods, page["metadata"]["resourceVersion"]
+
+    def schedule_config_write(self):
+        with self.vector_cfg_lock:
+            self.config_dirty = True
+        if self.config_dirty_event is not None:
+            # picked up by the config writer task once the debounce window has passed
+            self.config_dirty_event.set()
+        elif self.config_write_debounce_secs <= 0:
+            self.write_config()
+
+    @metrics.CONFIG_WRITE_SECONDS.time()
+    def write_config(self):
+        with self.config_write_lock:
+            with self.vector_cfg_lock:
+                # only rendering and copying the changed files happens under the lock, pod events keep being applied
+                # while the files are serialized and written
+                self.config_dirty = False
+                LOG.debug(f"Writing vector config: {str(self.vector_cfg)}")
+                file_changes = self.plan_config_file_changes(self.render_config_files(self.vector_cfg))
+                self.update_scrape_source_metrics(self.vector_cfg)
+            try:
+                written = self.apply_config_file_changes(file_changes)
+            except BaseException:
+                with self.vector_cfg_lock:
+                    # what is on disk is unknown now, the next write compares against the files again
+                    self.written_config_files = None
+                    self.config_dirty = True
+                raise
+            if self.checkpoint_path:
+                self.save_checkpoint()
+        if written:
+            metrics.CONFIG_WRITES.inc()
+            LOG.info(f"Vector config reloaded!")
+        else:
+            metrics.CONFIG_WRITES_SKIPPED.inc()
+            LOG.debug(f"Vector config unchanged, skipped write.")
+
+    @staticmethod
+    def update_scrape_source_metrics(vector_cfg: dict):
+        sources = vector_cfg.get("sources", {})
+        dcgm_source = sources.get(DCGM_EXPORTER_SOURCE_NAME)
+        metrics.ACTIVE_SCRAPE_SOURCES.labels("dcgm").set(1 if dcgm_source else 0)
+        metrics.ACTIVE_SCRAPE_ENDPOINTS.labels("dcgm").set(len(dcgm_source["endpoints"]) if dcgm_source else 0)
+        custom_metrics_source_names = [
+            VectorConfigReloader.resolve_source_name(vector_cfg, name)
+            for name in vector_cfg.get("transforms", {}).get(CUSTOM_METRICS_VECTOR_TRANSFORM_NAME, {}).get("inputs", [])
+        ]
+        custom_metrics_sources = [sources[name] for name in custom_metrics_source_names if name in sources]
+        metrics.ACTIVE_SCRAPE_SOURCES.labels("custom_metrics").set(len(custom_metrics_sources))
+        metrics.ACTIVE_SCRAPE_ENDPOINTS.labels("custom_metrics").set(sum(len(source["endpoints"]) for source in custom_metrics_sources))
+        # how often a limit is hit is reported by vector itself, per stage, as tag_value_limit_exceeded_total
+        metrics.SOURCE_SERIES_LIMIT.clear()
+        for name, transform in vector_cfg.get("transforms", {}).items():
+            if transform.get("type") == "tag_cardinality_limit" and name.endswith(CARDINALITY_LIMIT_STAGE_SUFFIX):
+                metrics.SOURCE_SERIES_LIMIT.labels(name[:-len(CARDINALITY_LIMIT_STAGE_SUFFIX)]).set(transform["value_limit"])
+
+    @staticmethod
+    def collect_upstream_components(vector_cfg: dict, input_name: str, fragment: dict):
+        # "<transform>.<output>" inputs refer to a named output of a transform
+        component_name = input_name.split(".")[0]
+        transforms, sources = vector_cfg.get("transforms", {}), vector_cfg.get("sources", {})
+        if component_name in transforms:
+            fragment.setdefault("transforms", {})[component_name] = transforms[component_name]
+            for upstream_input in transforms[component_name].get("inputs", []):
+                VectorConfigReloader.collect_upstream_components(vector_cfg, upstream_input, fragment)
+        elif component_name in sources:
+            fragment.setdefault("sources", {})[component_name] = sources[component_name]
+
+    def render_config_files(self, vector_cfg: dict) -> dict:
+        """File name -> config of every file the vector config is written to."""
+        # sized once per write, not per pod event
+        self.set_custom_metrics_sink_tuning(vector_cfg)
+        if self.config_output_mode == CONFIG_OUTPUT_MODE_FRAGMENTS:
+            return self.render_config_fragments(vector_cfg)
+        return {self.get_config_file_name(VectorConfigReloader.get_base_config_name()): vector_cfg}
+
+    def render_config_fragments(self, vector_cfg: dict) -> dict:
+        """Splits the vector config into the base config and one file per exporter.
+
+        Every exporter fragment carries its own copy of the enrichment transform and the sinks pick them up with
+        wildcard inputs, so adding or removing an exporter never touches the base config or any other fragment.
+        """
+        transforms = vector_cfg.get("transforms", {})
+        fragments = {}
+        exporter_components = set()
+
+        def add_exporter_fragment(fragment_name, fragment, enrich_transform_name, input_name):
+            enrich_transform = dict(transforms[enrich_transform_name], inputs=[input_name])
+            fragment.setdefault("transforms", {})[f"{enrich_transform_name}_{VectorConfigReloader.sanitize_name(input_name)}"] = enrich_transform
+            fragments[self.get_config_file_name(fragment_name)] = fragment
+            exporter_components.update(fragment.get("sources", {}), fragment.get("transforms", {}))
+
+        base_node_metrics_inputs = []
+        for input_name in transforms[NODE_METRICS_VECTOR_TRANSFORM_NAME].get("inputs", []):
+            fragment = {}
+            VectorConfigReloader.collect_upstream_components(vector_cfg, input_name, fragment)
+            if DCGM_EXPORTER_SOURCE_NAME in fragment.get("sources", {}):
+                add_exporter_fragment(VectorConfigReloader.get_fragment_name(vector_cfg, input_name), fragment, NODE_METRICS_VECTOR_TRANSFORM_NAME, input_name)
+            else:
+                base_node_metrics_inputs.append(input_name)
+
+        custom_metrics_inputs = transforms.get(CUSTOM_METRICS_VECTOR_TRANSFORM_NAME, {}).get("inputs", [])
+        for input_name in custom_metrics_inputs:
+            fragment = {}
+            VectorConfigReloader.collect_upstream_components(vector_cfg, input_name, fragment)
+            add_exporter_fragment(VectorConfigReloader.get_fragment_name(vector_cfg, input_name), fragment, CUSTOM_METRICS_VECTOR_TRANSFORM_NAME, input_name)
+
+        sinks = vector_cfg.get("sinks", {})
+        if custom_metrics_inputs and CUSTOM_METRICS_SINK_NAME in sinks:
+            fragments[self.get_config_file_name(CUSTOM_METRICS_SINK_FRAGMENT_NAME)] = {
+                "sinks": {CUSTOM_METRICS_SINK_NAME: dict(sinks[CUSTOM_METRICS_SINK_NAME], inputs=[f"{CUSTOM_METRICS_VECTOR_TRANSFORM_NAME}_*"])}
+            }
+
+        base_cfg = {key: value for key, value in vector_cfg.items() if key not in ("sources", "transforms", "sinks")}
+        base_cfg["sources"] = {name: source for name, source in vector_cfg.get("sources", {}).items() if name not in exporter_components}
+        base_cfg["transforms"] = {
+            name: transform for name, transform in transforms.items()
+            if name not in exporter_components and name != CUSTOM_METRICS_VECTOR_TRANSFORM_NAME
+        }
+        base_cfg["transforms"][NODE_METRICS_VECTOR_TRANSFORM_NAME] = dict(transforms[NODE_METRICS_VECTOR_TRANSFORM_NAME], inputs=base_node_metrics_inputs)
+        base_cfg["sinks"] = {name: sink for name, sink in sinks.items() if name != CUSTOM_METRICS_SINK_NAME}
+        node_metrics_sink = base_cfg["sinks"].get(NODE_METRICS_SINK_NAME)
+        if node_metrics_sink is not None:
+            # always matches the base enrich_node_metrics transform, so the wildcard never resolves to nothing
+            base_cfg["sinks"][NODE_METRICS_SINK_NAME] = dict(node_metrics_sink, inputs=[
+                f"{input_name}*" if input_name == NODE_METRICS_VECTOR_TRANSFORM_NAME else input_name for input_name in node_metrics_sink.get("inputs", [])
+            ])
+        fragments[self.get_config_file_name(VectorConfigReloader.get_base_config_name())] = base_cfg
+        return fragments
+
+    @staticmethod
+    def get_fragment_name(vector_cfg: dict, input_name: str) -> str:
+        # named after the scrape source, so adding or dropping one of its stages rewrites the same file
+        return f"{CONFIG_FRAGMENT_FILE_PREFIX}{VectorConfigReloader.sanitize_name(VectorConfigReloader.resolve_source_name(vector_cfg, input_name))}"
+
+    @staticmethod
+    def get_base_config_name() -> str:
+        return os.path.splitext(os.path.basename(VECTOR_CONFIG_PATH))[0]
+
+    def get_config_file_name(self, name: str) -> str:
+        return f"{name}.{self.config_serializer.extension}"
+
+    @staticmethod
+    def list_config_files() -> list:
+        """Config files this reloader manages, in any of the supported formats."""
+        try:
+            file_names = os.listdir(os.path.dirname(VECTOR_CONFIG_PATH))
+        except FileNotFoundError:
+            return []
+        config_files = []
+        for file_name in file_names:
+            name, _, extension = file_name.rpartition(".")
+            if extension in SERIALIZERS and (name == VectorConfigReloader.get_base_config_name() or name.startswith(CONFIG_FRAGMENT_FILE_PREFIX)):
+                config_files.append(file_name)
+        return config_files
+
+    def plan_config_file_changes(self, config_files: dict) -> list:
+        """Returns the ordered (file name, config or None to unlink) changes that bring the config dir to config_files."""
+        if self.written_config_files is None:
+            # files left behind by an earlier run (other output mode or format) are unlinked unless still wanted
+            self.written_config_files = {name: None for name in VectorConfigReloader.list_config_files()}
+
+        stale_files = [name for name in self.written_config_files if name not in config_files]
+        changed_files = [name for name, cfg in config_files.items() if cfg != self.written_config_files.get(name)]
+        # the custom metrics sink is removed before, and added after, the fragments its wildcard input matches
+        sink_fragment_file = self.get_config_file_name(CUSTOM_METRICS_SINK_FRAGMENT_NAME)
+        changed_files.sort(key=lambda name: name == sink_fragment_file)
+
+        file_changes = [(name, None) for name in stale_files if name == sink_fragment_file]
+        for name in changed_files:
+            # the copy is both what gets serialized outside the lock and what the next write compares against
+            self.written_config_files[name] = copy.deepcopy(config_files[name])
+            file_changes.append((name, self.written_config_files[name]))
+        file_changes.extend((name, None) for name in stale_files if name != sink_fragment_file)
+        for name in stale_files:
+            self.written_config_files.pop(name)
+        return file_changes
+
+    def apply_config_file_changes(self, file_changes: list) -> bool:
+        written = False
+        for name, cfg in file_changes:
+            path = os.path.join(os.path.dirname(VECTOR_CONFIG_PATH), name)
+            if cfg is not None:
+                written |= FileUtils.write_if_changed(path, self.config_serializer.dumps(cfg))
+                continue
+            try:
+                os.unlink(path)
+                written = True
+            except FileNotFoundError:
+                pass
+        return written
+
+    @staticmethod
+    def get_config_hash(config_files: dict) -> str:
+        return hashlib.sha256(json.dumps(config_files, sort_keys=True).encode()).hexdigest()
+
+    def save_checkpoint(self):
+        """Saves the checkpoint when the exporters or the rendered config changed, or to refresh its resourceVersion.
+
+        The resourceVersion is only a lower bound for the NotOlderThan list of the next start, a stale one is still
+        correct, so refreshing it alone is throttled to CHECKPOINT_REFRESH_INTERVAL_SECS.
+        """
+        with self.vector_cfg_lock:
+            exporters = [PodRecord.to_dict(pod) for pod in self.exporter_pods.values()]
+            node_tags = dict(self.node_tags)
+        # written_config_files is only changed by the writer, which holds config_write_lock
+        config_hash = VectorConfigReloader.get_config_hash(self.written_config_files)
+        state = (sorted((exporter["metadata"]["uid"], exporter["status"]["podIP"]) for exporter in exporters), config_hash)
+        resource_version = self.resource_version or self.checkpoint_resource_version
+        if state == self.saved_checkpoint_state and (
+            resource_version == self.saved_checkpoint_resource_version
+            or time.monotonic() - self.checkpoint_saved_at < CHECKPOINT_REFRESH_INTERVAL_SECS
+        ):
+            return
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "node_name": self.node_name,
+            "fingerprint": self.checkpoint_fingerprint,
+            "resource_version": resource_version,
+            "config_hash": config_hash,
+            "node_tags": node_tags,
+            "exporters": exporters,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+            FileUtils.atomic_write(self.checkpoint_path, json.dumps(checkpoint, sort_keys=True).encode("utf-8"))
+        except OSError as e:
+            # the checkpoint only speeds up the next start, a failed save must not fail the config write
+            LOG.warning(f"Failed to save checkpoint {self.checkpoint_path}: {e}")
+            return
+        self.saved_checkpoint_state = state
+        self.saved_checkpoint_resource_version = resource_version
+        self.checkpoint_saved_at = time.monotonic()
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "rb") as f:
+                checkpoint = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            LOG.warning(f"Ignoring unreadable checkpoint {self.checkpoint_path}: {e}")
+            return None
+        if checkpoint.get("version") != CHECKPOINT_VERSION or checkpoint.get("node_name") != self.node_name \
+                or checkpoint.get("fingerprint") != self.checkpoint_fingerprint:
+            LOG.info(f"Ignoring checkpoint {self.checkpoint_path} of another node, reloader or base config.")
+            return None
+        return checkpoint
+
+    def restore_checkpoint(self):
+        """Seeds the desired config with the checkpointed exporters and node tags, returns whether one was restored.
+
+        Nothing is written here. When the config files on disk are still the checkpointed ones they become the
+        written state, so the first write after the first pod list only touches what changed since and vector isn't
+        reloaded when the reloader restarts. A replaced agent pod finds no files and writes once the list is applied,
+        never the stale checkpointed exporters. The list starts from the checkpoint's resourceVersion.
+        """
+        if not self.checkpoint_path:
+            return False
+        checkpoint = self.load_checkpoint()
+        if checkpoint is None:
+            return False
+        pods = [PodRecord.from_dict(raw_pod) for raw_pod in checkpoint.get("exporters") or []]
+        with self.vector_cfg_lock:
+            # the node labels are only listed after the pods, the checkpointed tags render the same config meanwhile
+            self.node_tags = dict(checkpoint.get("node_tags") or self.node_tags)
+            if self.base_vector_cfg is not None:
+                self.set_enrichment_sources(self.base_vector_cfg)
+        vector_cfg = self.render_exporter_config(pods)
+        with self.config_write_lock, self.vector_cfg_lock:
+            self.vector_cfg = vector_cfg
+            self.exporter_pods = {pod.metadata.uid: pod for pod in pods if VectorConfigReloader.get_exporter_kind(pod) is not None}
+            config_files = self.render_config_files(vector_cfg)
+            if VectorConfigReloader.get_config_hash(config_files) == checkpoint.get("config_hash") \
+                    and sorted(VectorConfigReloader.list_config_files()) == sorted(config_files):
+                self.written_config_files = copy.deepcopy(config_files)
+        self.checkpoint_resource_version = checkpoint.get("resource_version")
+        # the checkpoint isn't saved again unless the same exporters render differently now
+        self.saved_checkpoint_state = (sorted((pod.metadata.uid, pod.status.pod_ip) for pod in pods), checkpoint.get("config_hash"))
+        self.saved_checkpoint_resource_version = self.checkpoint_resource_version
+        self.checkpoint_saved_at = time.monotonic()
+        LOG.info(f"Restored {len(pods)} exporters from checkpoint at resourceVersion {self.checkpoint_resource_version}.")
+        return True
 
+    def flush_config(self):
+        if self.config_dirty:
+            self.write_config()
+
+    @metrics.POD_EVENT_HANDLING_SECONDS.time()
     def handle_pod_event(self, event):
+        metrics.POD_EVENTS.labels(event["type"]).inc()
         pod = event["object"]
-        if not (VectorConfigReloader.is_pod_active(pod) or VectorConfigReloader.is_pod_terminating(pod)):
-            LOG.info(f"Pod {pod.metadata.name} state is neither running nor terminating.")
+        if VectorConfigReloader.get_exporter_kind(pod) is None:
+            LOG.info(f"Pod {pod.metadata.name} is not a relevant metrics exporter.")
             return
-        
-        current_vector_cfg = YamlUtils.load_yaml_config(VECTOR_CONFIG_PATH)
 
-        if VectorConfigReloader.is_pod_active(pod):
-            if VectorConfigReloader.is_custom_metrics_pod(pod):
-                self.set_custom_metrics_scrape_config(current_vector_cfg, [self.get_custom_metrics_endpoint_cfg(pod)])
-            elif VectorConfigReloader.is_dcgm_exporter_pod(pod):
-                self.set_dcgm_exporter_scrape_config(current_vector_cfg, self.get_dcgm_exporter_scrape_endpoint(pod.status.pod_ip))
-            else:
-                LOG.info(f"Pod {pod.metadata.name} is not a relevant metrics exporter.")
-                return
-        elif VectorConfigReloader.is_pod_terminating(pod):
-            if VectorConfigReloader.is_custom_metrics_pod(pod):
-                self.remove_custom_metrics_scrape_config(current_vector_cfg, self.get_custom_metrics_endpoint_cfg(pod))
-            elif VectorConfigReloader.is_dcgm_exporter_pod(pod):
-                self.remove_dcgm_exporter_scrape_config(current_vector_cfg)
+        with self.vector_cfg_lock:
+            if self.reconcile_touched_uids is not None:
+                self.reconcile_touched_uids.add(pod.metadata.uid)
+            # the pod as it was added, its annotations may have changed since
+            scraped_pod = self.exporter_pods.get(pod.metadata.uid)
+            if event["type"] == "DELETED" or not VectorConfigReloader.is_pod_active(pod):
+                self.discard_unready_exporter(pod)
+                if scraped_pod is None:
+                    return
+                self.exporter_pods.pop(pod.metadata.uid)
+                self.remove_exporter_scrape_config(self.vector_cfg, scraped_pod)
+                LOG.info(f"Pod {pod.metadata.name} is gone or going away, removed its scrape config.")
             else:
-                LOG.info(f"Pod {pod.metadata.name} is not a relevant metrics exporter.")
-                return
-
-        LOG.debug(f"Writing vector config: {str(current_vector_cfg)}")
-        # always update the node metrics transform source to handle LiteralStr issue
-        current_vector_cfg["transforms"][NODE_METRICS_VECTOR_TRANSFORM_NAME]["source"] = NODE_METRICS_VECTOR_TRANSFORM_SOURCE
-        YamlUtils.save_yaml(VECTOR_CONFIG_PATH, current_vector_cfg)
-        LOG.info(f"Vector config reloaded!")
+                if scraped_pod is not None and self.get_exporter_scrape_endpoint(scraped_pod) != self.get_exporter_scrape_endpoint(pod):
+                    self.exporter_pods.pop(pod.metadata.uid)
+                    self.remove_exporter_scrape_config(self.vector_cfg, scraped_pod)
+                if not self.is_exporter_ready(pod):
+                    LOG.info(f"Pod {pod.metadata.name} endpoint is not ready yet, deferring its scrape config.")
+                    return
+                self.set_exporter_scrape_config(self.vector_cfg, pod)
+                self.exporter_pods[pod.metadata.uid] = pod
 
-    def execute(self):
-        signal.signal(signal.SIGINT, self.handle_sigterm)
-        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        self.schedule_config_write()
 
-        self.bootstrap_config()
+    def stream_pod_events(self, **kwargs):
+        return self.stream_watch_events(self.k8s_api_client.list_pod_for_all_namespaces, **kwargs)
 
+    def stream_watch_events(self, list_func, **kwargs):
+        # reads the watch stream as raw JSON lines instead of letting the client build V1Pod models
+        resp = list_func(watch=True, _preload_content=False, **kwargs)
+        self.watch_responses.add(resp)
         try:
-            stream = self.k8s_event_watcher.stream(
-                self.k8s_api_client.list_pod_for_all_namespaces,
-                field_selector=f"spec.nodeName={self.node_name}",
-                _request_timeout=0
-            )
-            for event in stream:
-                self.handle_pod_event(event)
+            for line in iter_resp_lines(resp):
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["type"] == "ERROR":
+                    status = event["object"]
+                    raise client.ApiException(status=status.get("code"), reason=f"{status.get('reason')}: {status.get('message')}")
+                yield event
+        finally:
+            self.watch_responses.discard(resp)
+            resp.close()
+            resp.release_conn()
+
+    def watch_pod_events(self):
+        stream = self.stream_pod_events(
+            field_selector=self.get_pod_field_selector(),
+            resource_version=self.resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=WATCH_TIMEOUT_SECS,
+            _request_timeout=WATCH_TIMEOUT_SECS + WATCH_REQUEST_TIMEOUT_GRACE_SECS
+        )
+        for event in stream:
+            self.watch_failures = 0
+            raw_pod = event["object"]
+            # bookmarks carry no pod changes, only a newer resourceVersion to resume from
+            self.resource_version = raw_pod["metadata"]["resourceVersion"]
+            if event["type"] != "BOOKMARK" and VectorConfigReloader.is_metrics_exporter_pod_dict(raw_pod):
+                self.enqueue_pod_event({"type": event["type"], "object": PodRecord.from_dict(raw_pod)})
+            if not self.running:
+                stream.close()
+                break
+
+    def dispatch_event(self, event):
+        if event["type"] == SYNC_EVENT_TYPE:
+            self.apply_pod_list(event["object"])
+        elif event["type"] == EXPORTER_READY_EVENT_TYPE:
+            self.handle_exporter_ready(event["object"])
+        elif event["type"] == NODE_LABELS_EVENT_TYPE:
+            self.handle_node_labels(event["object"])
+        elif event["type"] == RECONCILE_EVENT_TYPE:
+            self.reconcile_sources(event["object"])
+        else:
+            self.handle_pod_event(event)
+
+    def enqueue_pod_event(self, event):
+        if self.loop is None:
+            self.dispatch_event(event)
+            return
+        # called from the watch thread, only blocks while the queue is full so events are never dropped
+        asyncio.run_coroutine_threadsafe(self.event_queue.put(event), self.loop).result()
+
+    def get_watch_backoff_secs(self, failures=None) -> float:
+        # full jitter exponential backoff, spreads reconnects of all nodes after an API server blip
+        failures = self.watch_failures if failures is None else failures
+        return random.uniform(0, min(WATCH_BACKOFF_MAX_SECS, WATCH_BACKOFF_BASE_SECS * 2 ** (failures - 1)))
+
+    def list_node(self):
+        # nodes can only be listed and watched, not fetched, with the agent's RBAC
+        resp = self.k8s_api_client.list_node(field_selector=f"metadata.name={self.node_name}", _preload_content=False)
+        node_list = json.loads(resp.data)
+        nodes = node_list.get("items") or []
+        if not nodes:
+            raise RuntimeError(f"Node {self.node_name} not found")
+        return nodes[0], node_list["metadata"]["resourceVersion"]
+
+    def watch_node_events(self, resource_version: str) -> str:
+        stream = self.stream_watch_events(
+            self.k8s_api_client.list_node,
+            field_selector=f"metadata.name={self.node_name}",
+            resource_version=resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=WATCH_TIMEOUT_SECS,
+            _request_timeout=WATCH_TIMEOUT_SECS + WATCH_REQUEST_TIMEOUT_GRACE_SECS
+        )
+        for event in stream:
+            node = event["object"]
+            resource_version = node["metadata"]["resourceVersion"]
+            if event["type"] in ("ADDED", "MODIFIED"):
+                self.enqueue_pod_event({"type": NODE_LABELS_EVENT_TYPE, "object": node["metadata"].get("labels") or {}})
+            if not self.running:
+                stream.close()
+                break
+        return resource_version
+
+    def request_shutdown(self):
+        self.running = False
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.shutdown_event.set)
+        for watch_response in list(self.watch_responses):
+            if hasattr(watch_response, "shutdown"):
+                # unblocks the watch threads' pending reads instead of waiting for the next event or bookmark
+                watch_response.shutdown()
+
+    async def watch_loop(self):
+        while self.running:
+            try:
+                if self.resource_version is None:
+                    pods, resource_version = await asyncio.to_thread(self.list_node_exporter_pods)
+                    # goes through the queue so events of the previous watch are applied before the re-list
+                    await self.event_queue.put({"type": SYNC_EVENT_TYPE, "object": pods})
+                    self.resource_version = resource_version
+                # returns when the server side watch timeout expires, then resumes from the last resourceVersion
+                await asyncio.to_thread(self.watch_pod_events)
+                if self.running:
+                    metrics.WATCH_RECONNECTS.labels("timeout").inc()
+                continue
+            except client.ApiException as e:
+                metrics.API_ERRORS.labels(str(e.status)).inc()
+                if e.status == HTTP_STATUS_GONE:
+                    # only re-list when the API server no longer has history for our resourceVersion
+                    LOG.info(f"Pod watch resourceVersion {self.resource_version} expired, re-listing pods.")
+                    metrics.WATCH_RECONNECTS.labels("gone").inc()
+                    self.resource_version = None
+                    continue
+                LOG.error(f"k8s event watcher error: {e}")
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                if not self.running:
+                    break
+                metrics.API_ERRORS.labels("connection").inc()
+                LOG.error(f"k8s event watcher connection error: {e}")
+
+            self.watch_failures += 1
+            if self.watch_failures > MAX_EVENT_WATCHER_RETRIES:
+                LOG.error(f"k8s event watcher failed {self.watch_failures} times in a row, giving up.")
+                break
+            metrics.WATCH_RECONNECTS.labels("error").inc()
+            backoff_secs = self.get_watch_backoff_secs()
+            LOG.info(f"Reconnecting k8s event watcher in {backoff_secs:.1f}s (attempt {self.watch_failures}/{MAX_EVENT_WATCHER_RETRIES}).")
+            try:
+                await asyncio.wait_for(self.shutdown_event.wait(), backoff_secs)
+            except asyncio.TimeoutError:
+                pass
+
+    async def node_watch_loop(self):
+        # keeps the node label derived tags up to date, its failures don't count against the pod watch's retries
+        resource_version, failures = None, 0
+        while self.running:
+            try:
+                if resource_version is None:
+                    node, resource_version = await asyncio.to_thread(self.list_node)
+                    await self.event_queue.put({"type": NODE_LABELS_EVENT_TYPE, "object": node["metadata"].get("labels") or {}})
+                resource_version = await asyncio.to_thread(self.watch_node_events, resource_version)
+                failures = 0
+                continue
+            except client.ApiException as e:
+                metrics.API_ERRORS.labels(str(e.status)).inc()
+                if e.status == HTTP_STATUS_GONE:
+                    resource_version = None
+                    continue
+                LOG.error(f"k8s node watcher error: {e}")
+            except (urllib3.exceptions.HTTPError, OSError, RuntimeError) as e:
                 if not self.running:
-                    self.k8s_event_watcher.stop()
                     break
-        except client.ApiException as e:
-            LOG.error(f"k8s event watcher error: {e}")
+                LOG.error(f"k8s node watcher error: {e}")
+            if resource_version is None:
+                # the node list failed, the first config isn't held back for it, the tags follow once it succeeds
+                self.complete_initial_sync(NODE_LABELS_EVENT_TYPE)
+            failures += 1
+            try:
+                await asyncio.wait_for(self.shutdown_event.wait(), self.get_watch_backoff_secs(failures))
+            except asyncio.TimeoutError:
+                pass
+
+    def get_initial_sync_event_types(self) -> set:
+        # with node label tags the first write also waits for the node's labels
+        return {SYNC_EVENT_TYPE, NODE_LABELS_EVENT_TYPE} if self.node_label_tags else {SYNC_EVENT_TYPE}
+
+    def complete_initial_sync(self, event_type: str):
+        if event_type not in self.initial_sync_pending:
+            return
+        self.initial_sync_pending.discard(event_type)
+        if not self.initial_sync_pending:
+            # the writes held back so far go out now, even if the last list changed nothing
+            self.schedule_config_write()
+
+    async def event_worker(self):
+        while True:
+            event = await self.event_queue.get()
+            metrics.POD_EVENT_QUEUE_SIZE.set(self.event_queue.qsize())
+            if event is None:
+                return
+            try:
+                if event["type"] in (SYNC_EVENT_TYPE, RECONCILE_EVENT_TYPE):
+                    await asyncio.to_thread(self.dispatch_event, event)
+                else:
+                    # only updates the in-memory config, rendering and writing is left to the config writer
+                    self.dispatch_event(event)
+            except Exception as e:
+                # one bad event must not stop the worker, the watch would block on the full queue for good
+                metrics.EVENT_HANDLING_ERRORS.labels(event["type"]).inc()
+                LOG.exception(f"Failed to handle {event['type']} event: {e}")
+            finally:
+                self.complete_initial_sync(event["type"])
 
+    async def config_writer(self):
+        failures = 0
+        while True:
+            await self.config_dirty_event.wait()
+            # coalesces every event of the debounce window into one write
+            await asyncio.sleep(self.config_write_debounce_secs)
+            self.config_dirty_event.clear()
+            if self.initial_sync_pending:
+                # set again by complete_initial_sync once the first lists are applied
+                continue
+            try:
+                await asyncio.to_thread(self.write_config)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                metrics.CONFIG_WRITE_ERRORS.inc()
+                backoff_secs = min(CONFIG_WRITE_RETRY_MAX_SECS, CONFIG_WRITE_RETRY_BASE_SECS * 2 ** (failures - 1))
+                LOG.error(f"Vector config write failed ({failures} in a row), retrying in {backoff_secs}s: {e}")
+                await asyncio.sleep(backoff_secs)
+                # write_config left the config dirty, the retry also picks up the events that came in meanwhile
+                self.config_dirty_event.set()
+
+    async def readiness_rechecker(self):
+        # exporters that come up after their probe retries ran out are added once a later probe passes
+        while True:
+            await asyncio.sleep(self.readiness_recheck_interval_secs)
+            with self.vector_cfg_lock:
+                unready_exporters = list(self.unready_exporters.values())
+            for pod in unready_exporters:
+                self.probe_exporter(pod)
+
+    async def reconciler(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval_secs)
+            if self.resource_version is None:
+                # a (re-)list is pending, it starts over anyway
+                continue
+            try:
+                pods = await asyncio.to_thread(self.list_reconcile_pods)
+            except client.ApiException as e:
+                metrics.API_ERRORS.labels(str(e.status)).inc()
+                LOG.error(f"k8s reconciliation list error: {e}")
+                continue
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                metrics.API_ERRORS.labels("connection").inc()
+                LOG.error(f"k8s reconciliation list connection error: {e}")
+                continue
+            # goes through the queue so it is applied in order with the watch's events
+            await self.event_queue.put({"type": RECONCILE_EVENT_TYPE, "object": pods})
+
+    def refresh_checkpoint(self):
+        with self.config_write_lock:
+            # nothing is checkpointed before the first write
+            if self.saved_checkpoint_state is not None:
+                self.save_checkpoint()
+
+    async def checkpoint_refresher(self):
+        # without pod changes the config isn't written, the checkpoint's resourceVersion moves forward from here
+        while True:
+            await asyncio.sleep(CHECKPOINT_REFRESH_INTERVAL_SECS)
+            await asyncio.to_thread(self.refresh_checkpoint)
+
+    def get_background_coroutines(self) -> list:
+        coroutines = [self.config_writer()]
+        if self.reconcile_interval_secs > 0:
+            coroutines.append(self.reconciler())
+        if self.checkpoint_path:
+            coroutines.append(self.checkpoint_refresher())
+        if self.endpoint_prober is not None:
+            coroutines.append(self.readiness_rechecker())
+        if self.node_label_tags:
+            coroutines.append(self.node_watch_loop())
+        return coroutines
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.event_queue = asyncio.Queue(maxsize=EVENT_QUEUE_MAX_SIZE)
+        self.config_dirty_event = asyncio.Event()
+        self.shutdown_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.request_shutdown)
+
+        if self.metrics_enabled:
+            metrics.start_metrics_server(self.metrics_address, self.metrics_port)
+            LOG.info(f"Serving reloader metrics on {self.metrics_address}:{self.metrics_port}/metrics")
+
+        self.initial_sync_pending = self.get_initial_sync_event_types()
+        await asyncio.to_thread(self.restore_checkpoint)
+        event_worker = asyncio.create_task(self.event_worker())
+        background_tasks = [asyncio.create_task(coro) for coro in self.get_background_coroutines()]
+        try:
+            await self.watch_loop()
+        finally:
+            # also stops the node watch when the pod watch gave up
+            self.request_shutdown()
+            if self.endpoint_prober is not None:
+                await asyncio.to_thread(self.endpoint_prober.shutdown)
+            # drain everything the watch delivered, then write the final config once
+            await self.event_queue.put(None)
+            await event_worker
+            for task in background_tasks:
+                task.cancel()
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+            await asyncio.to_thread(self.flush_config)
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self.loop.remove_signal_handler(sig)
         LOG.info("Exiting config reloader.")
 
+    def execute(self):
+        asyncio.run(self.run())
+
 if __name__ == "__main__":
     VectorConfigReloader().execute()